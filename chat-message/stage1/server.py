@@ -1,5 +1,7 @@
 import socket
 import time
+import threading
+from collections import OrderedDict
 
 # DGRAM = UDP
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -7,8 +9,23 @@ sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 server_address = ('localhost', 8080)
 # socketにIPアドレスとポートをバインド
 sock.bind(server_address)
-# {client_address: last_active_time}
-clients = {}
+# この秒数メッセージを送ってこないクライアントには送らない
+INACTIVE_TIMEOUT = 30
+# {client_address: last_active_time}（最後に送ってきた順に並べる。先頭が一番古い）
+clients = OrderedDict()
+clients_lock = threading.Lock()
+
+def expire_clients():
+    # 1秒ごとに先頭（一番古いクライアント）から期限切れのものだけを取り除く
+    # メッセージのたびに全員を調べ直さなくて済む
+    while True:
+        time.sleep(1)
+        deadline = time.time() - INACTIVE_TIMEOUT
+        with clients_lock:
+            while clients and next(iter(clients.values())) <= deadline:
+                clients.popitem(last=False)
+
+threading.Thread(target=expire_clients, daemon=True).start()
 
 while True:
     print('\nwaiting to receive message')
@@ -19,8 +36,11 @@ while True:
     # 第二引数はクライアント側のIP + エフェメラルポート(OS自動割当の動的ポート)
     data, client_address = sock.recvfrom(4096)
 
-    # clientの時間を記憶
-    clients[client_address] = time.time()
+    # clientの時間を記憶して末尾（一番新しい）に移す
+    with clients_lock:
+        clients[client_address] = time.time()
+        clients.move_to_end(client_address)
+        recipients = list(clients)
 
     # parse処理
     username_length = data[0]
@@ -28,19 +48,13 @@ while True:
     username = data[1:username_length+1]
     message = data[username_length+1:]
 
-    # for k, v in clients.items() どこから取るか
-    # k:v 何を入れるか
-    # if どれを残すか
-    # v > time.time() - 30 = 30秒以内のclients
-    clients = {k : v for k, v in clients.items() if v > time.time() - 30}
-
     # 受信したデータのバイト数と送信元のアドレスを表示します。
     print('received {} bytes from {}'.format(len(data), client_address))
     print(data.decode('utf-8'))
 
     # 受信したデータをそのまま送信元に送り返します。
     if data:
-        for client_addr in clients:
+        for client_addr in recipients:
             sent = sock.sendto(data, client_addr)
             # 送信したバイト数と送信先のアドレスを表示します。
             print('sent {} bytes back to {}'.format(sent, client_address))
\ No newline at end of file
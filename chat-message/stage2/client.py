@@ -11,6 +11,7 @@ import sys
 # --------------------------------------------------
 # サーバーのアドレスを設定（TCP用とUDP用）
 TCP_ADDRESS = ('localhost', 8080)
+# UDPのポートはトークンと一緒にサーバーから受け取る
 UDP_ADDRESS = ('localhost', 8081)
 
 # トークンを保存する変数を用意
@@ -102,11 +103,31 @@ print("リクエストが承認されました")
 # --------------------------------------------------
 # Step 7: TCPでトークンを受信（State=2）
 # --------------------------------------------------
+def recv_exact(sock, size):
+    """sizeバイト受信するまで読む（最近のメッセージは大きいので1回のrecvで届くとは限らない）"""
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("サーバーとの接続が切れました")
+        data += chunk
+    return data
+
 # トークンサイズ（1バイト）+ トークン
 token_size_byte = tcp_sock.recv(1)
 token_size = token_size_byte[0]
 token = tcp_sock.recv(token_size).decode('utf-8')
 print(f"トークンを受信しました: {token[:8]}...")
+# メッセージを送るUDPポート（2バイト）。サーバーがルームごとに担当のプロセスのポートを返す
+udp_port = int.from_bytes(recv_exact(tcp_sock, 2), 'big')
+UDP_ADDRESS = (TCP_ADDRESS[0], udp_port)
+print(f"UDPの送信先: {UDP_ADDRESS}")
+# 参加する前にルームで話されていた最近のメッセージ（件数2バイト + [長さ2バイト + データグラム] * 件数）
+history_count = int.from_bytes(recv_exact(tcp_sock, 2), 'big')
+history = []
+for _ in range(history_count):
+    history_size = int.from_bytes(recv_exact(tcp_sock, 2), 'big')
+    history.append(recv_exact(tcp_sock, history_size))
 
 # TCP接続を閉じる
 tcp_sock.close()
@@ -169,6 +190,13 @@ def parse_udp_message(data):
 
     return recv_room_name, recv_token, message
 
+# 参加する前の最近のメッセージを表示
+if history:
+    print(f"\n=== これまでのメッセージ（{len(history)}件） ===")
+    for data in history:
+        _, _, message = parse_udp_message(data)
+        print(message)
+
 # --------------------------------------------------
 # Step 11: 送信スレッドと受信スレッドを作成
 # --------------------------------------------------
@@ -0,0 +1,227 @@
+"""
+sendmmsg/recvmmsgをctypesで呼び出す（Linux専用）
+- sendmmsg: 1つのデータグラムを1回のシステムコールで複数の宛先に送る
+- recvmmsg: 届いているデータグラムを1回のシステムコールでまとめて受け取る
+使えない環境やIPv4以外の宛先では1件ずつsendto/recvfromする
+"""
+import ctypes
+import ctypes.util
+import errno
+import functools
+import os
+import socket
+import struct
+import threading
+
+# 1回のsendmmsgで送る最大件数（カーネルの上限UIO_MAXIOVと同じ）
+SENDMMSG_BATCH = 1024
+# struct sockaddr_inの大きさ
+SOCKADDR_IN_SIZE = 16
+# 1件でも届いたら待たずに返す（recvmmsgのフラグ）
+MSG_WAITFORONE = 0x10000
+# 受信した送信元を(ip, port)に変換した結果を覚えておく件数（同じ相手から何度も届くので）
+ADDRESS_CACHE_SIZE = 4096
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', msghdr),
+        ('msg_len', ctypes.c_uint),
+    ]
+
+
+def load_libc_function(name, argtypes):
+    """libcの関数を探す（無ければNone）"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        function = getattr(libc, name)
+    except (OSError, AttributeError, TypeError):
+        return None
+    function.argtypes = argtypes
+    function.restype = ctypes.c_int
+    return function
+
+
+sendmmsg = load_libc_function('sendmmsg', [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int])
+recvmmsg = load_libc_function('recvmmsg', [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p])
+
+
+def pack_sockaddr_in(address):
+    """(ip, port)をstruct sockaddr_inのバイト列にする（IPv4でなければNone）"""
+    try:
+        packed_ip = socket.inet_aton(address[0])
+    except (OSError, TypeError, IndexError):
+        return None
+    return struct.pack('=H', socket.AF_INET) + struct.pack('!H', address[1]) + packed_ip + bytes(8)
+
+
+def unpack_sockaddr_in(name):
+    """struct sockaddr_inのバイト列を(ip, port)にする"""
+    return socket.inet_ntoa(name[4:8]), struct.unpack('!H', name[2:4])[0]
+
+
+# 送信元が入れ替わり続けても増え続けないように、使われていないものから捨てる
+cached_unpack_sockaddr_in = functools.lru_cache(maxsize=ADDRESS_CACHE_SIZE)(unpack_sockaddr_in)
+
+
+class Destinations:
+    """
+    同じデータグラムを送る宛先の一覧
+    宛先ごとのmmsghdrは作成時に1度だけ用意し、送るたびにデータの場所だけを書き換える
+    （書き換えたものを他のスレッドに使われないよう、送っている間はロックする）
+    """
+
+    def __init__(self, addresses):
+        self.addresses = tuple(addresses)
+        self.index = {address: i for i, address in enumerate(self.addresses)}
+        self.lock = threading.Lock()
+        self.messages = None
+
+        names = [pack_sockaddr_in(address) for address in self.addresses]
+        if sendmmsg is None or not self.addresses or None in names:
+            return
+        self.names = ctypes.create_string_buffer(b''.join(names), len(names) * SOCKADDR_IN_SIZE)
+        self.iov = iovec()
+        self.messages = (mmsghdr * len(names))()
+        base = ctypes.addressof(self.names)
+        for i, message in enumerate(self.messages):
+            message.msg_hdr.msg_name = base + i * SOCKADDR_IN_SIZE
+            message.msg_hdr.msg_namelen = SOCKADDR_IN_SIZE
+            message.msg_hdr.msg_iov = ctypes.pointer(self.iov)
+            message.msg_hdr.msg_iovlen = 1
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def send(self, sock, data, skip=None):
+        """skip以外の全ての宛先にdataを送り、(送れた数, 失敗した数)を返す"""
+        skip_index = self.index.get(skip)
+        if skip_index is None:
+            ranges = [(0, len(self.addresses))]
+        else:
+            ranges = [(0, skip_index), (skip_index + 1, len(self.addresses))]
+
+        if self.messages is None:
+            return self.send_each(sock, data, ranges)
+
+        sent = 0
+        errors = 0
+        buffer = ctypes.c_char_p(data)
+        with self.lock:
+            self.iov.iov_base = ctypes.cast(buffer, ctypes.c_void_p)
+            self.iov.iov_len = len(data)
+            base = ctypes.addressof(self.messages)
+            for start, end in ranges:
+                while start < end:
+                    count = min(end - start, SENDMMSG_BATCH)
+                    result = sendmmsg(sock.fileno(), base + start * ctypes.sizeof(mmsghdr), count, 0)
+                    if result < 0:
+                        if ctypes.get_errno() == errno.EINTR:
+                            continue
+                        # 先頭の宛先に送れなかったので、それを飛ばして続ける
+                        errors += 1
+                        start += 1
+                        continue
+                    sent += result
+                    start += result
+        return sent, errors
+
+    def send_each(self, sock, data, ranges):
+        """sendmmsgが使えないときは1件ずつ送る"""
+        sent = 0
+        errors = 0
+        for start, end in ranges:
+            for address in self.addresses[start:end]:
+                try:
+                    sock.sendto(data, address)
+                    sent += 1
+                except OSError:
+                    errors += 1
+        return sent, errors
+
+
+class Receiver:
+    """
+    1つのソケットからデータグラムをまとめて受け取る（スレッドごとに1つ作る）
+    受信用のバッファは作成時に用意して使い回す
+    """
+
+    def __init__(self, sock, batch, size):
+        self.sock = sock
+        self.batch = batch
+        self.size = size
+        self.messages = None
+        if recvmmsg is None or sock.family != socket.AF_INET:
+            return
+        self.buffers = ctypes.create_string_buffer(batch * size)
+        self.names = ctypes.create_string_buffer(batch * SOCKADDR_IN_SIZE)
+        self.iovs = (iovec * batch)()
+        self.messages = (mmsghdr * batch)()
+        self.view = memoryview(self.buffers).cast('B')
+        # mmsghdrのうちmsg_lenだけを読む形式
+        self.length_format = struct.Struct(f'{mmsghdr.msg_len.offset}xI{ctypes.sizeof(mmsghdr) - mmsghdr.msg_len.offset - 4}x')
+        buffers = ctypes.addressof(self.buffers)
+        names = ctypes.addressof(self.names)
+        for i in range(batch):
+            self.iovs[i].iov_base = buffers + i * size
+            self.iovs[i].iov_len = size
+            header = self.messages[i].msg_hdr
+            header.msg_name = names + i * SOCKADDR_IN_SIZE
+            header.msg_iov = ctypes.pointer(self.iovs[i])
+            header.msg_iovlen = 1
+            header.msg_namelen = SOCKADDR_IN_SIZE
+        # 前回受け取った件数（msg_namelenが書き換えられているので戻す）
+        self.last_count = 0
+
+    def recv(self):
+        """1件届くまで待ち、その時点で届いている分（最大batch件）を[(data, address), ...]で返す"""
+        if self.messages is None:
+            return self.recv_each()
+        for i in range(self.last_count):
+            self.messages[i].msg_hdr.msg_namelen = SOCKADDR_IN_SIZE
+        while True:
+            count = recvmmsg(self.sock.fileno(), ctypes.addressof(self.messages), self.batch, MSG_WAITFORONE, None)
+            if count >= 0:
+                break
+            error = ctypes.get_errno()
+            if error != errno.EINTR:
+                raise OSError(error, os.strerror(error))
+        # ctypesのフィールドを1つずつ読むと遅いので、受信した長さと送信元はまとめてバイト列から取り出す
+        lengths = self.length_format.iter_unpack(ctypes.string_at(ctypes.addressof(self.messages), count * ctypes.sizeof(mmsghdr)))
+        names = ctypes.string_at(ctypes.addressof(self.names), count * SOCKADDR_IN_SIZE)
+        self.last_count = count
+        received = []
+        for i, (length,) in enumerate(lengths):
+            offset = i * self.size
+            address = cached_unpack_sockaddr_in(names[i * SOCKADDR_IN_SIZE:(i + 1) * SOCKADDR_IN_SIZE])
+            received.append((self.view[offset:offset + length].tobytes(), address))
+        return received
+
+    def recv_each(self):
+        """recvmmsgが使えないときは、1件待ってから届いている分をノンブロッキングで読む"""
+        received = [self.sock.recvfrom(self.size)]
+        while len(received) < self.batch:
+            try:
+                received.append(self.sock.recvfrom(self.size, socket.MSG_DONTWAIT))
+            except (BlockingIOError, InterruptedError):
+                break
+        return received
@@ -2,48 +2,467 @@ import socket
 import threading
 import secrets
 import time
+import math
+import os
+import sys
+import json
+import bisect
+import base64
+import hashlib
+import asyncio
+import multiprocessing
+import queue
+from array import array
+from collections import deque
+
+from mmsg import Destinations, Receiver
+
+# uvloopがあればasyncioモードのイベントループに使う（無ければ標準のイベントループ）
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
-# TCPソケットとUDPソケットを作成
-tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 # それぞれのポートにbind
 tcp_address = ('localhost', 8080)
 udp_address = ('localhost', 8081)
-# socketにIPアドレスとポートをバインド
-tcp_sock.bind(tcp_address)
+# 'asyncio': 1つのイベントループでTCPとUDPを処理する / 'threaded': TCPとUDPを別々のスレッドで処理する
+# 'multiprocess': TCPの作成・参加はフロントのプロセス、UDPの転送はルームを担当するワーカープロセスが行う（引数で上書きできる）
+SERVER_MODE = 'asyncio'
+# multiprocessモードのワーカープロセスの数（i番目のワーカーはUDPポート udp_address[1] + i で転送する）
+WORKER_PROCESSES = os.cpu_count() or 1
+# フロントとワーカーがやり取りするUNIXドメインソケットのパス（{}にワーカーの番号が入る）
+WORKER_SOCKET_PATH = '/chat_worker_{}_socket_file'
+# 一貫性ハッシュの輪に置く1ワーカーあたりの点の数（多いほどルームが均等に分かれる）
+HASH_RING_REPLICAS = 64
+# IPCのフレームの先頭に付ける本体の長さ（4バイト・ビッグエンディアン）
+FRAME_HEADER_SIZE = 4
 # tcpは待ち受ける数を指定する
-tcp_sock.listen(5)
-udp_sock.bind(udp_address)
+TCP_BACKLOG = 128
+# asyncioモードで作成・参加のリクエストを読み終えるまで待つ秒数（遅いクライアントを切る）
+TCP_HANDSHAKE_TIMEOUT = 10
+
+# ルーム一覧を分ける数（ルーム名のハッシュで振り分け、分けた単位ごとにロックする）
+ROOM_SHARDS = 16
+# UDPを受信して転送するスレッドの数（別々のルームのメッセージを同時に処理できる）
+UDP_WORKERS = 4
+# SO_REUSEPORTが使えれば、スレッドごとに同じポートへbindしたソケットを持ち、カーネルに振り分けてもらう
+UDP_REUSEPORT = hasattr(socket, 'SO_REUSEPORT')
+# 1回のrecvmmsgで受け取る最大件数と、1件の最大バイト数
+RECV_BATCH = 64
+UDP_RECV_SIZE = 4096
+# UDPの受信バッファの大きさ（転送が追いつかない間に届いた分をカーネルで溜めておく。上限はnet.core.rmem_max）
+UDP_RECV_BUFFER = 4 * 1024 * 1024
+# この秒数メッセージを送ってこないクライアントには転送しない
+INACTIVE_TIMEOUT = 30
+# この秒数使われなかったトークンは無効にする（トークンが無くなったルームは削除する）
+TOKEN_TIMEOUT = 600
+# 期限切れを調べる間隔（秒）とタイマーホイールのバケツの数
+EXPIRY_TICK = 1
+EXPIRY_SLOTS = 64
+# 転送の件数などの集計を表示する間隔（秒）
+STATS_INTERVAL = 10
+# ルームごとの送信待ちの列の長さの上限
+ROOM_QUEUE_DEPTH = 256
+# 送信待ちがあふれたときに捨てるメッセージ
+# 'oldest': 一番古いもの / 'newest': 届いたもの / 'coalesce': 同じ送信者の一番古いもの（無ければ一番古いもの）
+DROP_POLICY = 'oldest'
+# ルームから送る1秒あたりのメッセージ数の上限（ルームの全員が同じものを受け取るので、1人あたりの上限と同じ）
+# 超えた分は捨てる。Noneなら上限なし
+ROOM_SEND_RATE = None
+# ROOM_SEND_RATEを一時的に超えてよい件数
+ROOM_SEND_BURST = 50
+# 送信役が1つのルームから続けて送る最大件数（送り終えたら他のルームに順番を譲る）
+SEND_BATCH = 32
+# threadedモードで送信待ちを送るスレッドの数
+SENDER_THREADS = 4
+# ルームごとに覚えておく最近のメッセージの件数と、それを入れておくバイト列の大きさ（どちらかが一杯になったら古いものから消える）
+HISTORY_MESSAGES = 64
+HISTORY_BYTES = 32 * 1024
+# 参加したときにTCPの応答でまとめて送る最近のメッセージの件数
+HISTORY_REPLAY = 20
+
+# メッセージごとに表示する代わりに数えておき、STATS_INTERVALごとにまとめて表示する
+STAT_NAMES = ('received', 'relayed', 'sent', 'send_errors', 'invalid', 'dropped', 'rate_limited')
+# 受信のたびにロックを取らないように、スレッドごとのカウンタに足していき、表示するときに合計する
+stats_local = threading.local()
+# 全スレッドのカウンタ（ロックはスレッドが初めて数えるときの登録にだけ使う）
+thread_stats = []
+stats_lock = threading.Lock()
+# 前回表示したときの合計（差分を表示する）
+reported_stats = dict.fromkeys(STAT_NAMES, 0)
+
+def count_stats(**counts):
+    stats = getattr(stats_local, 'counts', None)
+    if stats is None:
+        # キーを最初にそろえておくと、他のスレッドが合計するときに辞書の大きさが変わらない
+        stats = stats_local.counts = dict.fromkeys(STAT_NAMES, 0)
+        with stats_lock:
+            thread_stats.append(stats)
+    for name, count in counts.items():
+        stats[name] += count
+
+class TimerWheel:
+    """
+    期限切れを調べるためのタイマーホイール
+    1tickごとに1つのバケツを取り出す。メッセージが届いても登録し直さず最終アクティブ時間を更新するだけなので、
+    期限を調べ直すのは1人あたり期限1回分につき1度で済む（ホイール1周より長い期限は1周ごとに調べ直す）
+    """
+
+    def __init__(self, tick, slot_count):
+        self.tick = tick
+        self.slots = [set() for _ in range(slot_count)]
+        self.position = 0
+        self.lock = threading.Lock()
+
+    def schedule(self, key, delay):
+        """delay秒後（1周より長ければ1周後）のバケツにkeyを入れる"""
+        ticks = min(max(1, math.ceil(delay / self.tick)), len(self.slots) - 1)
+        with self.lock:
+            self.slots[(self.position + ticks) % len(self.slots)].add(key)
+
+    def advance(self):
+        """1tick進めて、期限が来たkeyを返す"""
+        with self.lock:
+            keys = self.slots[self.position]
+            self.slots[self.position] = set()
+            self.position = (self.position + 1) % len(self.slots)
+        return keys
+
+# ('client', room, address) と ('token', room, token) の期限を管理する
+expiry_wheel = TimerWheel(EXPIRY_TICK, EXPIRY_SLOTS)
+
+# 全ルームのトークンの索引 {token（バイト列）: Room}
+# UDPで届いたトークンからルームを1回の辞書引きで見つける。TCPでの作成・参加で登録し、期限切れ・ルームの削除で消す
+# （辞書の1回の読み書きはGILで守られるのでロックは取らない）
+token_index = {}
+
+# 送信待ちのあるルームのRoomOutboxを送信役に渡す関数
+# threadedモードは送信スレッドの待ち行列に入れ、asyncioモードはイベントループで後から送る
+schedule_drain = None
+
+class RoomOutbox:
+    """
+    ルームごとの送信待ちの列。長さに上限があり、あふれたらDROP_POLICYに従って捨てる
+    受信した処理は列に入れるだけで戻り、送るのは送信役なので、混んでいるルームが他のルームの転送を止めない
+    """
+
+    def __init__(self):
+        # [(sock, data, recipients, skip), ...]
+        self.queue = deque()
+        # 送信役に渡してあればTrue（同じルームを2つの送信役が同時に送らないようにする）
+        self.scheduled = False
+        # ROOM_SEND_RATEのトークンバケツ
+        self.rate_tokens = ROOM_SEND_BURST
+        self.refilled_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take_rate_token(self):
+        """ROOM_SEND_RATEの範囲内ならTrue（self.lockを持った状態で呼ぶ）"""
+        now = time.monotonic()
+        self.rate_tokens = min(ROOM_SEND_BURST, self.rate_tokens + (now - self.refilled_at) * ROOM_SEND_RATE)
+        self.refilled_at = now
+        if self.rate_tokens < 1:
+            return False
+        self.rate_tokens -= 1
+        return True
+
+    def drop_one(self, sender):
+        """あふれたので列から1件捨てる（self.lockを持った状態で呼ぶ）"""
+        if DROP_POLICY == 'coalesce':
+            for i, (_, _, _, skip) in enumerate(self.queue):
+                if skip == sender:
+                    del self.queue[i]
+                    return
+        self.queue.popleft()
+
+    def put(self, sock, data, recipients, sender, force=False):
+        """
+        sender以外のrecipientsに送るdataを列に入れる。捨てたらFalse
+        forceなら上限を無視する（ホスト退出の通知など、必ず届けたいもの）
+        """
+        with self.lock:
+            if not force:
+                if ROOM_SEND_RATE is not None and not self.take_rate_token():
+                    count_stats(rate_limited=1)
+                    return False
+                if len(self.queue) >= ROOM_QUEUE_DEPTH:
+                    count_stats(dropped=1)
+                    if DROP_POLICY == 'newest':
+                        return False
+                    self.drop_one(sender)
+            self.queue.append((sock, data, recipients, sender))
+            if self.scheduled:
+                return True
+            self.scheduled = True
+        schedule_drain(self)
+        return True
+
+    def drain(self):
+        """送信待ちをSEND_BATCH件まで送る。まだ残っていればもう一度送信役に渡す"""
+        with self.lock:
+            batch = [self.queue.popleft() for _ in range(min(SEND_BATCH, len(self.queue)))]
+        sent = 0
+        errors = 0
+        for sock, data, recipients, sender in batch:
+            try:
+                result = recipients.send(sock, data, skip=sender)
+            except OSError as e:
+                print(f"送信エラー: {e}")
+                result = (0, len(recipients))
+            sent += result[0]
+            errors += result[1]
+        count_stats(sent=sent, send_errors=errors)
+        with self.lock:
+            if not self.queue:
+                self.scheduled = False
+                return
+        schedule_drain(self)
+
+class MessageHistory:
+    """
+    ルームで転送した最近のデータグラムのリングバッファ
+    中身は最初に確保した1つのbytearrayに順に書き込み、(開始位置, 長さ)を固定長のarrayで持つ
+    末尾に入りきらないものは先頭に戻って書き、上書きされる古いものから消える
+    """
+
+    def __init__(self):
+        self.arena = bytearray(HISTORY_BYTES)
+        # [開始位置, 長さ] をHISTORY_MESSAGES件分
+        self.records = array('l', [0]) * (2 * HISTORY_MESSAGES)
+        # 一番古いものの番号と件数
+        self.head = 0
+        self.count = 0
+        # 次に書き込む位置
+        self.write_at = 0
+
+    def drop_oldest(self):
+        self.head = (self.head + 1) % HISTORY_MESSAGES
+        self.count -= 1
+
+    def append(self, data):
+        """データグラムを覚える（ルームのlockを持った状態で呼ぶ）"""
+        size = len(data)
+        if not 0 < size <= len(self.arena):
+            return
+        start = self.write_at
+        if start + size > len(self.arena):
+            # 末尾に入らないので先頭に戻る。末尾の残りにあるものは先頭のものより古いので先に消える
+            while self.count and self.records[2 * self.head] >= start:
+                self.drop_oldest()
+            start = 0
+        end = start + size
+        # 書き込む範囲に重なる古いものを消す
+        while self.count:
+            oldest_start = self.records[2 * self.head]
+            if not (oldest_start < end and start < oldest_start + self.records[2 * self.head + 1]):
+                break
+            self.drop_oldest()
+        if self.count == HISTORY_MESSAGES:
+            self.drop_oldest()
+
+        self.arena[start:end] = data
+        slot = (self.head + self.count) % HISTORY_MESSAGES
+        self.records[2 * slot] = start
+        self.records[2 * slot + 1] = size
+        self.count += 1
+        self.write_at = end
+
+    def recent(self, limit):
+        """最近のものを古い順に最大limit件返す（ルームのlockを持った状態で呼ぶ）"""
+        messages = []
+        for i in range(max(0, self.count - limit), self.count):
+            slot = (self.head + i) % HISTORY_MESSAGES
+            start = self.records[2 * slot]
+            messages.append(bytes(self.arena[start:start + self.records[2 * slot + 1]]))
+        return messages
+
+class Room:
+    """1つのチャットルーム。メンバーの変更はルームごとのロックで守る。トークンはUDPのヘッダーと同じバイト列で持つ"""
+
+    def __init__(self, name, host_token, host_name, host_ip):
+        self.name = name
+        # UDPで届いたルーム名とデコードせずに比べるため
+        self.name_bytes = name.encode('utf-8')
+        self.host_token = host_token
+        self.host_name = host_name
+        # {token: ip_address}
+        self.tokens = {host_token: host_ip}
+        # {token: 最後に使われた時刻}
+        self.token_active = {host_token: time.time()}
+        # {address: {'last_active': timestamp, 'token': token}}
+        self.clients = {}
+        # 転送先の一覧。メンバーが変わったときだけ作り直し、転送はロックの外でこれを使う
+        self.members = Destinations(())
+        # ホストが退出したらTrue（削除された後に届いたメッセージは捨てる）
+        self.closed = False
+        self.lock = threading.Lock()
+        # 送信待ちの列（転送はroom.lockの外で、この列を通して行う）
+        self.outbox = RoomOutbox()
+        # 後から参加した人に送る最近のメッセージ
+        self.history = MessageHistory()
+
+    def update_members(self):
+        """転送先の一覧を作り直す（self.lockを持った状態で呼ぶ）"""
+        self.members = Destinations(self.clients)
+
+    def add_token(self, token, ip_address):
+        """トークンを登録して期限切れの確認を予約する（self.lockを持った状態で呼ぶ）"""
+        self.tokens[token] = ip_address
+        self.token_active[token] = time.time()
+        token_index[token] = self
+        expiry_wheel.schedule(('token', self, token), TOKEN_TIMEOUT)
+
+    def remove_token(self, token):
+        """トークンを無効にする（self.lockを持った状態で呼ぶ）"""
+        del self.tokens[token]
+        del self.token_active[token]
+        token_index.pop(token, None)
 
-# チャットルームを管理する辞書を用意 {room_name: {host_token, tokens: {token: ip_address}, clients: {address: last_active}}}
-chat_rooms = {}
-# スレッドセーフのためのロック
-rooms_lock = threading.Lock()
+    def close(self):
+        """ルームを閉じて、全てのトークンを索引から消す（self.lockを持った状態で呼ぶ）"""
+        self.closed = True
+        for token in self.tokens:
+            token_index.pop(token, None)
+
+class RoomRegistry:
+    """ルーム名のハッシュで分けたルームの一覧。作成・削除はそのルームが入っている部分だけをロックする"""
+
+    def __init__(self, shard_count):
+        # [({room_name: Room}, lock), ...]
+        self.shards = [({}, threading.Lock()) for _ in range(shard_count)]
+
+    def shard(self, room_name):
+        return self.shards[hash(room_name) % len(self.shards)]
+
+    def create(self, room_name, host_token, host_name, host_ip):
+        """ルームを作成する。既に同じ名前のルームがあればNone"""
+        rooms, lock = self.shard(room_name)
+        with lock:
+            if room_name in rooms:
+                return None
+            room = Room(room_name, host_token, host_name, host_ip)
+            rooms[room_name] = room
+            token_index[host_token] = room
+        expiry_wheel.schedule(('token', room, host_token), TOKEN_TIMEOUT)
+        return room
+
+    def get(self, room_name):
+        rooms, lock = self.shard(room_name)
+        with lock:
+            return rooms.get(room_name)
+
+    def remove(self, room):
+        """ルームを削除する（同じ名前で作り直されたルームは消さない）"""
+        rooms, lock = self.shard(room.name)
+        with lock:
+            if rooms.get(room.name) is room:
+                del rooms[room.name]
+
+# チャットルームの一覧
+chat_rooms = RoomRegistry(ROOM_SHARDS)
 
 def generate_token():
     """ユニークなトークンを生成"""
     return secrets.token_hex(16)
 
-def handle_tcp():
+def create_tcp_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # socketにIPアドレスとポートをバインド
+    sock.bind(tcp_address)
+    sock.listen(TCP_BACKLOG)
+    return sock
+
+def parse_tcp_header(header):
+    """
+    32バイトのヘッダーを (room_name_size, operation, state, operation_payload_size) にする
+    スレッド版とasyncio版のTCP処理で共通
+    """
+    # --------------------------------------------------
+    # Step 2: TCP - ヘッダー（32バイト）をパースする
+    # --------------------------------------------------
+    room_name_size = header[0]
+    operation = header[1]
+    state = header[2]
+    # OperationPayloadSizeは29バイト（ヘッダーの残り）
+    operation_payload_size = int.from_bytes(header[3:32], 'big')
+    return room_name_size, operation, state, operation_payload_size
+
+def add_member(operation, room_name, payload, client_ip, token_bytes):
+    """
+    ルームを作成する（ホストとして登録）またはルームに参加する（ゲストとして登録）
+    成功したら参加者に送る最近のメッセージのリスト（作成なら空）、失敗したらNoneを返す
+    multiprocessモードではルームを担当するワーカープロセスがIPCで受けて呼ぶ
+    """
+    # --------------------------------------------------
+    # Step 4: TCP - 部屋の作成処理（Operation=1）
+    # --------------------------------------------------
+    if operation == 1:
+        # ルームを作成してホストとして登録（ルーム名が既に存在すればNone）
+        room = chat_rooms.create(room_name, token_bytes, payload, client_ip)
+        if room is None:
+            return None  # ルームが既に存在
+
+        print(f"ルーム '{room_name}' を作成しました。トークン: {token_bytes.decode('utf-8')}")
+        return []
+
+    # --------------------------------------------------
+    # Step 5: TCP - 部屋への参加処理（Operation=2）
+    # --------------------------------------------------
+    # ルーム名が存在するかチェックし、ルーム情報にトークンを追加（ゲストとして登録）
+    room = chat_rooms.get(room_name)
+    if room is None:
+        return None  # ルームが存在しない
+    with room.lock:
+        if room.closed:
+            return None
+        room.add_token(token_bytes, client_ip)
+        history = room.history.recent(HISTORY_REPLAY)
+
+    print(f"ユーザー '{payload}' がルーム '{room_name}' に参加しました。トークン: {token_bytes.decode('utf-8')}")
+    return history
+
+def build_reply(token_bytes, udp_port, history=()):
+    """クライアントに返す応答（token_bytesがNoneなら失敗）"""
+    if token_bytes is None:
+        # State=1: ステータスコード（失敗）を含む応答
+        return bytes([1])  # 1 = 失敗（作成ならルームが既に存在、参加ならルームが存在しない）
+    # State=1: ステータスコード（成功）に続けて、State=2: トークンサイズ（1バイト）+ トークン + UDPポート（2バイト）
+    # + 最近のメッセージの件数（2バイト）+ [データグラムの長さ（2バイト）+ データグラム] * 件数
+    reply = [bytes([0]), bytes([len(token_bytes)]), token_bytes, udp_port.to_bytes(2, 'big'), len(history).to_bytes(2, 'big')]
+    for message in history:
+        reply.append(len(message).to_bytes(2, 'big'))
+        reply.append(message)
+    return b''.join(reply)
+
+def handle_request(operation, room_name, payload, client_ip):
+    """
+    ルームの作成・参加を行い、クライアントに返す応答（バイト列）を返す
+    スレッド版とasyncio版のTCP処理で共通
+    """
+    # トークンを生成（ユニークな文字列）
+    token_bytes = generate_token().encode('utf-8')
+    history = add_member(operation, room_name, payload, client_ip, token_bytes)
+    if history is None:
+        return build_reply(None, None)
+    return build_reply(token_bytes, udp_address[1], history)
+
+async def handle_request_async(operation, room_name, payload, client_ip):
+    return handle_request(operation, room_name, payload, client_ip)
+
+def handle_tcp(tcp_sock):
     while True:
         # 接続を受け付ける tcpではbind→listen→accept→recvという手順が必要
         client_socket, client_address = tcp_sock.accept()
         print(f"TCP接続: {client_address}")
 
         try:
-            # --------------------------------------------------
-            # Step 2: TCP - ヘッダー（32バイト）をパースする
-            # --------------------------------------------------
             header = client_socket.recv(32)
             if len(header) < 32:
                 client_socket.close()
                 continue
 
-            room_name_size = header[0]
-            operation = header[1]
-            state = header[2]
-            # OperationPayloadSizeは29バイト（ヘッダーの残り）
-            operation_payload_size = int.from_bytes(header[3:32], 'big')
+            room_name_size, operation, state, operation_payload_size = parse_tcp_header(header)
 
             # --------------------------------------------------
             # Step 3: TCP - ボディをパースする
@@ -61,68 +480,8 @@ def handle_tcp():
 
             print(f"ルーム名: {room_name}, Operation: {operation}, State: {state}, ペイロード: {payload}")
 
-            # --------------------------------------------------
-            # Step 4: TCP - 部屋の作成処理（Operation=1）
-            # --------------------------------------------------
-            if operation == 1:
-                with rooms_lock:
-                    # ルーム名が既に存在するかチェック
-                    if room_name in chat_rooms:
-                        # State=1: ステータスコード（失敗）を含む応答を送信
-                        response = bytes([1])  # 1 = 失敗（ルームが既に存在）
-                        client_socket.send(response)
-                        client_socket.close()
-                        continue
-
-                    # State=1: ステータスコード（成功）を含む応答を送信
-                    response = bytes([0])  # 0 = 成功
-                    client_socket.send(response)
-
-                    # トークンを生成（ユニークな文字列）
-                    token = generate_token()
-
-                    # ルーム情報を辞書に保存（ホストとして登録）
-                    chat_rooms[room_name] = {
-                        'host_token': token,
-                        'host_name': payload,
-                        'tokens': {token: client_address[0]},
-                        'clients': {}  # {address: {'last_active': timestamp, 'token': token, 'username': name}}
-                    }
-
-                    # State=2: トークンをクライアントに送信
-                    token_bytes = token.encode('utf-8')
-                    # トークンサイズ（1バイト）+ トークン
-                    client_socket.send(bytes([len(token_bytes)]) + token_bytes)
-                    print(f"ルーム '{room_name}' を作成しました。トークン: {token}")
-
-            # --------------------------------------------------
-            # Step 5: TCP - 部屋への参加処理（Operation=2）
-            # --------------------------------------------------
-            elif operation == 2:
-                with rooms_lock:
-                    # ルーム名が存在するかチェック
-                    if room_name not in chat_rooms:
-                        # State=1: ステータスコード（失敗）を含む応答を送信
-                        response = bytes([1])  # 1 = 失敗（ルームが存在しない）
-                        client_socket.send(response)
-                        client_socket.close()
-                        continue
-
-                    # State=1: ステータスコード（成功）を含む応答を送信
-                    response = bytes([0])  # 0 = 成功
-                    client_socket.send(response)
-
-                    # トークンを生成（ユニークな文字列）
-                    token = generate_token()
-
-                    # ルーム情報にトークンを追加（ゲストとして登録）
-                    chat_rooms[room_name]['tokens'][token] = client_address[0]
-
-                    # State=2: トークンをクライアントに送信
-                    token_bytes = token.encode('utf-8')
-                    # トークンサイズ（1バイト）+ トークン
-                    client_socket.send(bytes([len(token_bytes)]) + token_bytes)
-                    print(f"ユーザー '{payload}' がルーム '{room_name}' に参加しました。トークン: {token}")
+            if operation in (1, 2):
+                client_socket.sendall(handle_request(operation, room_name, payload, client_address[0]))
 
             # TCP接続を閉じる
             client_socket.close()
@@ -131,132 +490,536 @@ def handle_tcp():
             print(f"TCP処理エラー: {e}")
             client_socket.close()
 
-def handle_udp():
+async def read_request_async(reader):
+    """asyncio版: ヘッダーとボディを読み、(operation, state, room_name, payload) を返す"""
+    header = await reader.readexactly(32)
+    room_name_size, operation, state, operation_payload_size = parse_tcp_header(header)
+
+    # --------------------------------------------------
+    # Step 3: TCP - ボディをパースする
+    # --------------------------------------------------
+    room_name = (await reader.readexactly(room_name_size)).decode('utf-8')
+    payload = (await reader.readexactly(operation_payload_size)).decode('utf-8')
+    return operation, state, room_name, payload
+
+async def handle_tcp_async(reader, writer, handle_request_async):
+    """
+    asyncio版のTCP処理。読み込みを待つ間も他の接続やUDPの転送は止まらない
+    handle_request_asyncはこのプロセスで登録するか、担当のワーカープロセスに頼むかで変わる
+    """
+    client_address = writer.get_extra_info('peername')
+    print(f"TCP接続: {client_address}")
+    try:
+        operation, state, room_name, payload = await asyncio.wait_for(read_request_async(reader), TCP_HANDSHAKE_TIMEOUT)
+        print(f"ルーム名: {room_name}, Operation: {operation}, State: {state}, ペイロード: {payload}")
+
+        if operation in (1, 2):
+            writer.write(await handle_request_async(operation, room_name, payload, client_address[0]))
+            await writer.drain()
+
+    except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError, UnicodeDecodeError) as e:
+        # OSErrorにはmultiprocessモードでワーカーにつながらなかった場合も含む
+        print(f"TCP処理エラー: {e!r}")
+    finally:
+        # TCP接続を閉じる
+        writer.close()
+
+def create_udp_socket(address=udp_address):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if UDP_REUSEPORT:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RECV_BUFFER)
+    # socketにIPアドレスとポートをバインド
+    sock.bind(address)
+    return sock
+
+def handle_udp(sock):
+    # 届いているデータグラムをrecvmmsgでまとめて受信（使えなければ1件ずつ）
+    receiver = Receiver(sock, RECV_BATCH, UDP_RECV_SIZE)
     while True:
         # データと送信元アドレスを受信
-        # udpはrecvfrom必要
-        data, client_address = udp_sock.recvfrom(4096)
-        print(f"UDP受信: {client_address}")
+        received = receiver.recv()
+        count_stats(received=len(received))
+
+        for data, client_address in received:
+            try:
+                relay_datagram(sock, data, client_address)
+            except Exception as e:
+                print(f"UDP処理エラー: {e}")
 
+class ChatDatagramProtocol(asyncio.DatagramProtocol):
+    """asyncio版のUDP受信。届いたデータグラムはスレッド版と同じrelay_datagramで転送する"""
+
+    def __init__(self, sock):
+        # 転送にはsendmmsgを使うので、トランスポートではなくソケットを直接使う
+        self.sock = sock
+
+    def datagram_received(self, data, client_address):
+        count_stats(received=1)
         try:
-            # --------------------------------------------------
-            # Step 6: UDP - ヘッダー（2バイト）をパースする
-            # --------------------------------------------------
-            if len(data) < 2:
-                continue
+            relay_datagram(self.sock, data, client_address)
+        except Exception as e:
+            print(f"UDP処理エラー: {e}")
 
-            room_name_size = data[0]
-            token_size = data[1]
+def relay_datagram(sock, data, client_address):
+    # --------------------------------------------------
+    # Step 6: UDP - ヘッダー（2バイト）をパースする
+    # --------------------------------------------------
+    if len(data) < 2:
+        return
 
-            # --------------------------------------------------
-            # Step 7: UDP - ボディをパースする
-            # --------------------------------------------------
-            offset = 2
-            # RoomNameSizeバイト分を読んでルーム名を取得
-            room_name = data[offset:offset + room_name_size].decode('utf-8')
-            offset += room_name_size
+    room_name_size = data[0]
+    token_size = data[1]
 
-            # TokenSizeバイト分を読んでトークンを取得
-            token = data[offset:offset + token_size].decode('utf-8')
-            offset += token_size
+    # --------------------------------------------------
+    # Step 7: UDP - ボディをパースする
+    # --------------------------------------------------
+    # 転送するのは受け取ったデータそのままなので、ルーム名・トークン・メッセージは文字列にデコードしない
+    offset = 2 + room_name_size
+    # TokenSizeバイト分を読んでトークンを取得
+    token = data[offset:offset + token_size]
+    offset += token_size
 
-            # 残りをメッセージとして取得
-            message = data[offset:].decode('utf-8')
+    # --------------------------------------------------
+    # Step 8: UDP - トークンとIPアドレスの検証
+    # --------------------------------------------------
+    # トークンの索引からルームを探し、ルーム名が一致するか確認
+    room = token_index.get(token)
+    if room is None or data[2:2 + room_name_size] != room.name_bytes:
+        count_stats(invalid=1)
+        return
 
-            print(f"ルーム: {room_name}, トークン: {token[:8]}..., メッセージ: {message}")
+    # ルームのロックはメンバー情報の更新だけに使い、転送はロックを外してから行う
+    with room.lock:
+        # ロックを取る前に無効になったトークン
+        if room.closed or token not in room.tokens:
+            count_stats(invalid=1)
+            return
 
-            # --------------------------------------------------
-            # Step 8: UDP - トークンとIPアドレスの検証
-            # --------------------------------------------------
-            with rooms_lock:
-                # ルームが存在するか確認
-                if room_name not in chat_rooms:
-                    print(f"ルーム '{room_name}' が存在しません")
-                    continue
-
-                room = chat_rooms[room_name]
-
-                # トークンがルームに登録されているか確認
-                if token not in room['tokens']:
-                    print(f"無効なトークン: {token[:8]}...")
-                    continue
-
-                # トークンに紐づくIPアドレスと送信元IPが一致するか確認
-                registered_ip = room['tokens'][token]
-                sender_ip = client_address[0]
-
-                # localhostの場合は127.0.0.1として扱う
-                if registered_ip == 'localhost':
-                    registered_ip = '127.0.0.1'
-                if sender_ip == 'localhost':
-                    sender_ip = '127.0.0.1'
-
-                # IPアドレスの検証（開発環境ではlocalhostなので緩和）
-                # 本番環境では厳密にチェックすべき
-                # if registered_ip != sender_ip:
-                #     print(f"IPアドレス不一致: 登録={registered_ip}, 送信元={sender_ip}")
-                #     continue
-
-                # --------------------------------------------------
-                # Step 9: UDP - メッセージのリレー
-                # --------------------------------------------------
-                # クライアントの最終アクティブ時間を更新
-                current_time = time.time()
-                room['clients'][client_address] = {
-                    'last_active': current_time,
-                    'token': token
-                }
-
-                # 30秒以上非アクティブなクライアントを削除
-                inactive_clients = []
-                for addr, info in room['clients'].items():
-                    if current_time - info['last_active'] > 30:
-                        inactive_clients.append(addr)
-
-                for addr in inactive_clients:
-                    del room['clients'][addr]
-                    print(f"非アクティブなクライアントを削除: {addr}")
-
-                # --------------------------------------------------
-                # Step 10: ホスト退出時の処理
-                # --------------------------------------------------
-                # ホストが退出したらルームを削除
-                if token == room['host_token'] and message == "/exit":
-                    # ルーム内の全クライアントに切断メッセージを送信
-                    disconnect_msg = "HOST_DISCONNECTED".encode('utf-8')
-                    for addr in room['clients']:
-                        if addr != client_address:
-                            udp_sock.sendto(disconnect_msg, addr)
-
-                    del chat_rooms[room_name]
-                    print(f"ホストが退出したためルーム '{room_name}' を削除しました")
-                    continue
-
-                # ルーム内の全クライアントにメッセージを転送
-                relay_message = data  # 元のデータをそのまま転送
-                for addr in room['clients']:
-                    if addr != client_address:  # 送信者以外に転送
-                        udp_sock.sendto(relay_message, addr)
-                        print(f"メッセージを転送: {addr}")
+        # トークンに紐づくIPアドレスと送信元IPが一致するか確認
+        registered_ip = room.tokens[token]
+        sender_ip = client_address[0]
+
+        # localhostの場合は127.0.0.1として扱う
+        if registered_ip == 'localhost':
+            registered_ip = '127.0.0.1'
+        if sender_ip == 'localhost':
+            sender_ip = '127.0.0.1'
+
+        # IPアドレスの検証（開発環境ではlocalhostなので緩和）
+        # 本番環境では厳密にチェックすべき
+        # if registered_ip != sender_ip:
+        #     print(f"IPアドレス不一致: 登録={registered_ip}, 送信元={sender_ip}")
+        #     return
+
+        # --------------------------------------------------
+        # Step 9: UDP - メッセージのリレー
+        # --------------------------------------------------
+        # クライアントとトークンの最終アクティブ時間を更新（非アクティブなクライアントの削除はexpire_inactiveが行う）
+        current_time = time.time()
+        room.token_active[token] = current_time
+        client = room.clients.get(client_address)
+        if client is None:
+            room.clients[client_address] = {
+                'last_active': current_time,
+                'token': token
+            }
+            room.update_members()
+            expiry_wheel.schedule(('client', room, client_address), INACTIVE_TIMEOUT)
+        else:
+            client['last_active'] = current_time
+            client['token'] = token
 
+        # --------------------------------------------------
+        # Step 10: ホスト退出時の処理
+        # --------------------------------------------------
+        # ホストが退出したらルームを削除（メッセージの中身を見るのはホストの"/exit"だけ）
+        host_exit = token == room.host_token and data.endswith(b'/exit') and len(data) - offset == 5
+        if host_exit:
+            room.close()
+        else:
+            room.history.append(data)
+
+        # 転送先はロックを持っている間に取り出しておく（作り直されるだけで中身は変わらない）
+        recipients = room.members
+
+    if host_exit:
+        chat_rooms.remove(room)
+        # ルーム内の全クライアントに切断メッセージを送信
+        disconnect_msg = "HOST_DISCONNECTED".encode('utf-8')
+        room.outbox.put(sock, disconnect_msg, recipients, client_address, force=True)
+
+        print(f"ホストが退出したためルーム '{room.name}' を削除しました")
+        return
+
+    # ルーム内の全クライアント（送信者以外）にメッセージを転送（送信待ちの列に入れ、送信役がsendmmsgでまとめて送る）
+    relay_message = data  # 元のデータをそのまま転送
+    if room.outbox.put(sock, relay_message, recipients, client_address):
+        count_stats(relayed=1)
+
+def expire(key, current_time):
+    """期限が来たクライアント・トークンを確認し、まだ使われていれば期限を予約し直す"""
+    kind, room, target = key
+    with room.lock:
+        if room.closed:
+            return
+        if kind == 'client':
+            client = room.clients.get(target)
+            if client is None:
+                return
+            remaining = client['last_active'] + INACTIVE_TIMEOUT - current_time
+            if remaining > 0:
+                expiry_wheel.schedule(key, remaining)
+                return
+            del room.clients[target]
+            room.update_members()
+            print(f"非アクティブなクライアントを削除: {target}")
+            return
+
+        last_active = room.token_active.get(target)
+        if last_active is None:
+            return
+        remaining = last_active + TOKEN_TIMEOUT - current_time
+        if remaining > 0:
+            expiry_wheel.schedule(key, remaining)
+            return
+        room.remove_token(target)
+        print(f"使われていないトークンを無効にしました: {target[:8].decode('utf-8')}...")
+        # トークンが1つも残っていなければルームを削除
+        if room.tokens:
+            return
+        room.close()
+    chat_rooms.remove(room)
+    print(f"誰もいなくなったルーム '{room.name}' を削除しました")
+
+def expire_due():
+    """タイマーホイールを1tick進め、期限が来たものを処理する"""
+    current_time = time.time()
+    for key in expiry_wheel.advance():
+        try:
+            expire(key, current_time)
         except Exception as e:
-            print(f"UDP処理エラー: {e}")
+            print(f"期限切れ処理エラー: {e}")
 
-# threadを分けて処理待ち targetが処理するメソッド
-tcp_thread = threading.Thread(target=handle_tcp, daemon=True)
-tcp_thread.start()
-udp_thread = threading.Thread(target=handle_udp, daemon=True)
-udp_thread.start()
+def report_stats():
+    """前回から今回までの受信・転送の件数を表示する"""
+    with stats_lock:
+        snapshots = [dict(stats) for stats in thread_stats]
+    totals = {name: sum(stats[name] for stats in snapshots) for name in STAT_NAMES}
+    counts = {name: totals[name] - reported_stats[name] for name in STAT_NAMES}
+    reported_stats.update(totals)
+    if any(counts.values()):
+        print(f"UDP集計({STATS_INTERVAL}秒): 受信 {counts.get('received', 0)}件, "
+              f"転送 {counts.get('relayed', 0)}件, 送信 {counts.get('sent', 0)}件, "
+              f"送信失敗 {counts.get('send_errors', 0)}件, 無効なトークン {counts.get('invalid', 0)}件, "
+              f"あふれて破棄 {counts.get('dropped', 0)}件, 上限超過で破棄 {counts.get('rate_limited', 0)}件")
 
-print("サーバーが起動しました")
-print(f"TCP: {tcp_address}")
-print(f"UDP: {udp_address}")
+def run_every(interval, function):
+    """スレッド版: interval秒ごとにfunctionを呼ぶ"""
+    while True:
+        time.sleep(interval)
+        function()
 
-# メインスレッドを維持
-try:
+async def run_every_async(interval, function):
+    """asyncio版: interval秒ごとにfunctionを呼ぶ"""
     while True:
-        time.sleep(1)
-except KeyboardInterrupt:
-    print("\nサーバーを終了します")
-    tcp_sock.close()
-    udp_sock.close()
+        await asyncio.sleep(interval)
+        function()
+
+def send_outboxes(sender_queue):
+    """threadedモードの送信役: 送信待ちのあるルームを順番に取り出して送る"""
+    while True:
+        sender_queue.get().drain()
+
+def serve_threaded():
+    """TCPとUDPを別々のスレッドで処理する"""
+    global schedule_drain
+    tcp_sock = create_tcp_socket()
+
+    # 送信待ちのあるルームはSENDER_THREADS個のスレッドが順番に送る
+    sender_queue = queue.SimpleQueue()
+    schedule_drain = sender_queue.put
+    for _ in range(SENDER_THREADS):
+        threading.Thread(target=send_outboxes, args=(sender_queue,), daemon=True).start()
+
+    # threadを分けて処理待ち targetが処理するメソッド
+    tcp_thread = threading.Thread(target=handle_tcp, args=(tcp_sock,), daemon=True)
+    tcp_thread.start()
+    # UDPは複数のスレッドで受信する（送受信のシステムコールの間はGILが外れるので別のルームの処理が重なる）
+    # SO_REUSEPORTが使えればスレッドごとのソケット、使えなければ1つのソケットを共有する
+    if UDP_REUSEPORT:
+        udp_socks = [create_udp_socket() for _ in range(UDP_WORKERS)]
+    else:
+        udp_socks = [create_udp_socket()] * UDP_WORKERS
+    for udp_sock in udp_socks:
+        udp_thread = threading.Thread(target=handle_udp, args=(udp_sock,), daemon=True)
+        udp_thread.start()
+    # 非アクティブなクライアント・トークン・空のルームを削除するスレッド
+    expiry_thread = threading.Thread(target=run_every, args=(EXPIRY_TICK, expire_due), daemon=True)
+    expiry_thread.start()
+    stats_thread = threading.Thread(target=run_every, args=(STATS_INTERVAL, report_stats), daemon=True)
+    stats_thread.start()
+
+    print("サーバーが起動しました（threadedモード）")
+    print(f"TCP: {tcp_address}")
+    print(f"UDP: {udp_address}")
+
+    # メインスレッドを維持
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("\nサーバーを終了します")
+        tcp_sock.close()
+        for udp_sock in set(udp_socks):
+            udp_sock.close()
+
+async def start_relay(address):
+    """UDPの転送と、非アクティブなクライアント・トークン・空のルームの削除、集計の表示を始める"""
+    global schedule_drain
+    loop = asyncio.get_running_loop()
+    # 送信待ちはイベントループで送る（1回にSEND_BATCH件までなので、その間に他のルームや受信の処理が入る）
+    schedule_drain = lambda outbox: loop.call_soon(outbox.drain)
+    udp_sock = create_udp_socket(address)
+    udp_sock.setblocking(False)
+    transport, _ = await loop.create_datagram_endpoint(lambda: ChatDatagramProtocol(udp_sock), sock=udp_sock)
+    background = [
+        asyncio.create_task(run_every_async(EXPIRY_TICK, expire_due)),
+        asyncio.create_task(run_every_async(STATS_INTERVAL, report_stats)),
+    ]
+    return transport, background
+
+async def serve_asyncio():
+    """1つのイベントループでTCPの作成・参加とUDPの転送を処理する（スレッドの切り替えが起きない）"""
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_tcp_async(reader, writer, handle_request_async),
+        sock=create_tcp_socket(),
+    )
+    transport, background = await start_relay(udp_address)
+
+    print(f"サーバーが起動しました（asyncioモード{'、uvloop' if uvloop is not None else ''}）")
+    print(f"TCP: {tcp_address}")
+    print(f"UDP: {udp_address}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for task in background:
+            task.cancel()
+        transport.close()
+
+# --------------------------------------------------
+# multiprocessモード: フロントとワーカープロセス
+# --------------------------------------------------
+def encode_frame(message):
+    """IPCのメッセージをフレームにする"""
+    payload = json.dumps(message).encode('utf-8')
+    return len(payload).to_bytes(FRAME_HEADER_SIZE, 'big') + payload
+
+async def read_frame(reader):
+    size = int.from_bytes(await reader.readexactly(FRAME_HEADER_SIZE), 'big')
+    return json.loads((await reader.readexactly(size)).decode('utf-8'))
+
+def hash_key(text):
+    """一貫性ハッシュの位置（プロセスごとに変わるhash()ではなくmd5を使う）"""
+    return int.from_bytes(hashlib.md5(text.encode('utf-8')).digest()[:8], 'big')
+
+class WorkerConnection:
+    """
+    フロントからワーカー1つへのIPC接続
+    リクエストにIDを付けて返事を待たずに続けて送り、届いた返事はIDで待っているリクエストに渡す
+    （同じワーカーが担当するルームへの作成・参加も1件ずつ待たずに同時に進む）
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        # 返事を待っているリクエスト {id: Future}
+        self.pending = {}
+        self.next_id = 0
+        self.closed = False
+        self.receiver = asyncio.create_task(self.receive_replies())
+
+    async def request(self, message):
+        request_id = self.next_id
+        self.next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            self.writer.write(encode_frame({**message, 'id': request_id}))
+            await self.writer.drain()
+            return await future
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def receive_replies(self):
+        """返事を読み、IDの合うリクエストに渡す。接続が切れたら待っている全てのリクエストを失敗させる"""
+        error = ConnectionError("ワーカーとの接続が切れました")
+        try:
+            while True:
+                reply = await read_frame(self.reader)
+                future = self.pending.pop(reply['id'], None)
+                if future is not None and not future.done():
+                    future.set_result(reply)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            error = ConnectionError(f"ワーカーとの接続が切れました: {e}")
+        finally:
+            self.closed = True
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self.pending.clear()
+            self.writer.close()
+
+class WorkerRouter:
+    """
+    フロントのプロセスで使う。ルーム名の一貫性ハッシュで担当のワーカープロセスを決め、作成・参加をIPCで頼む
+    ワーカーを増減しても、担当が変わるのはそのワーカーの分のルームだけで済む
+    """
+
+    def __init__(self, worker_count):
+        points = sorted((hash_key(f'worker-{index}-{replica}'), index)
+                        for index in range(worker_count) for replica in range(HASH_RING_REPLICAS))
+        self.ring_keys = [key for key, _ in points]
+        self.ring_workers = [index for _, index in points]
+        # ワーカーごとのIPC接続（使うときに作り、切れていたら作り直す）
+        self.connections = [None] * worker_count
+        # 同時に届いたリクエストがそれぞれ接続を作らないように、接続するときだけ使う
+        self.locks = [asyncio.Lock() for _ in range(worker_count)]
+
+    def worker_for(self, room_name):
+        """ルーム名から担当のワーカーの番号を返す（輪の上で次にあるワーカーの点）"""
+        position = bisect.bisect(self.ring_keys, hash_key(room_name)) % len(self.ring_keys)
+        return self.ring_workers[position]
+
+    async def connection(self, index):
+        connection = self.connections[index]
+        if connection is None or connection.closed:
+            async with self.locks[index]:
+                connection = self.connections[index]
+                if connection is None or connection.closed:
+                    reader, writer = await asyncio.open_unix_connection(WORKER_SOCKET_PATH.format(index))
+                    connection = self.connections[index] = WorkerConnection(reader, writer)
+        return connection
+
+    async def request(self, index, message):
+        connection = await self.connection(index)
+        return await connection.request(message)
+
+    async def handle_request(self, operation, room_name, payload, client_ip):
+        """担当のワーカーに登録を頼み、クライアントに返す応答（ワーカーのUDPポート付き）を返す"""
+        index = self.worker_for(room_name)
+        # トークンを生成（ユニークな文字列）
+        token = generate_token()
+        reply = await self.request(index, {
+            'operation': operation,
+            'room_name': room_name,
+            'payload': payload,
+            'client_ip': client_ip,
+            'token': token,
+        })
+        if reply['history'] is None:
+            return build_reply(None, None)
+        history = [base64.b64decode(message) for message in reply['history']]
+        return build_reply(token.encode('utf-8'), udp_address[1] + index, history)
+
+async def handle_ipc(reader, writer):
+    """ワーカーのプロセスで使う。フロントから届いた作成・参加を自分のルーム一覧に登録する（返事には同じIDを付ける）"""
+    try:
+        while True:
+            message = await read_frame(reader)
+            history = add_member(message['operation'], message['room_name'], message['payload'],
+                                 message['client_ip'], message['token'].encode('utf-8'))
+            # JSONで送れるように最近のメッセージはbase64にする（失敗ならNone）
+            if history is not None:
+                history = [base64.b64encode(data).decode('ascii') for data in history]
+            writer.write(encode_frame({'id': message['id'], 'history': history}))
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def serve_worker(index):
+    """ワーカープロセス: 担当のルームのUDP転送と、フロントからの登録を処理する"""
+    transport, background = await start_relay((udp_address[0], udp_address[1] + index))
+    server = await asyncio.start_unix_server(handle_ipc, path=WORKER_SOCKET_PATH.format(index))
+    print(f"ワーカー{index}が起動しました UDP: {udp_address[1] + index}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for task in background:
+            task.cancel()
+        transport.close()
+
+def run_worker(index):
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    try:
+        asyncio.run(serve_worker(index))
+    except KeyboardInterrupt:
+        pass
+
+async def wait_for_workers(workers):
+    """全てのワーカーがIPCを受け付けるようになるまで待つ（起動中に終了したワーカーがあれば止める）"""
+    for index, worker in enumerate(workers):
+        while not os.path.exists(WORKER_SOCKET_PATH.format(index)):
+            if not worker.is_alive():
+                print(f"ワーカー{index}が起動中に終了しました（終了コード {worker.exitcode}）")
+                sys.exit(1)
+            await asyncio.sleep(0.05)
+
+async def serve_front(workers):
+    """フロントのプロセス: TCPの作成・参加を受け付け、ルームを担当のワーカーに振り分ける"""
+    await wait_for_workers(workers)
+    worker_count = len(workers)
+    router = WorkerRouter(worker_count)
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_tcp_async(reader, writer, router.handle_request),
+        sock=create_tcp_socket(),
+    )
+    print(f"サーバーが起動しました（multiprocessモード、ワーカー{worker_count}個）")
+    print(f"TCP: {tcp_address}")
+    print(f"UDP: {udp_address[1]}〜{udp_address[1] + worker_count - 1}")
+    async with server:
+        await server.serve_forever()
+
+def serve_multiprocess():
+    """ワーカープロセスを起動してからフロントを動かす（ルームの数と転送の量をコアの数だけ増やせる）"""
+    for index in range(WORKER_PROCESSES):
+        try:
+            # もし前回の実行でソケットファイルが残っていた場合、そのファイルを削除します（起動したかどうかをファイルで判断するため）
+            os.unlink(WORKER_SOCKET_PATH.format(index))
+        except FileNotFoundError:
+            pass
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_worker, args=(index,), daemon=True) for index in range(WORKER_PROCESSES)]
+    for worker in workers:
+        worker.start()
+    try:
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        asyncio.run(serve_front(workers))
+    except KeyboardInterrupt:
+        print("\nサーバーを終了します")
+    finally:
+        for worker in workers:
+            worker.terminate()
+
+if __name__ == '__main__':
+    mode = sys.argv[1] if len(sys.argv) > 1 else SERVER_MODE
+    if mode == 'asyncio':
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        try:
+            asyncio.run(serve_asyncio())
+        except KeyboardInterrupt:
+            print("\nサーバーを終了します")
+    elif mode == 'threaded':
+        serve_threaded()
+    elif mode == 'multiprocess':
+        serve_multiprocess()
+    else:
+        print(f"不明なモードです: {mode} (asyncio、threaded または multiprocess)")
+        sys.exit(1)
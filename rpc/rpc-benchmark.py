@@ -0,0 +1,89 @@
+import os
+import sys
+import time
+import random
+import string
+import importlib.util
+from typing import Callable, List
+
+# 測る入力の大きさ（引数に 'quick' を付けると小さいものだけ測る）
+ANAGRAM_LENGTHS = [16, 64, 128, 256, 512, 1000, 10000, 100000, 1000000]
+SORT_SIZES = [1000, 10000, 100000, 1000000]
+SORT_KEY_LENGTHS = [4, 8, 16, 32]
+EXTERNAL_SORT_SIZES = [100000, 1000000, 2000000]
+# 1つの組み合わせを測る回数（一番速かったものを使う）
+REPEAT = 3
+
+# rpc-server.pyはファイル名にハイフンが入っているのでパスから読み込む（サーバは起動しない）
+spec = importlib.util.spec_from_file_location('rpc_server', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rpc-server.py'))
+server = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(server)
+
+"""関数を何回か実行して一番速かった時間(ms)を返す"""
+def measure(function: Callable, *args, copy_list: bool = False) -> float:
+    best = float('inf')
+    for _ in range(REPEAT):
+        # 入力を書き換える関数にはコピーを渡す
+        call_args = [list(args[0])] + list(args[1:]) if copy_list else args
+        start = time.perf_counter()
+        function(*call_args)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+"""表の1行を表示する。validAnagram・sortが実際に選ぶ方法には * を付ける"""
+def print_row(label: str, times: List[float], chosen: int) -> None:
+    cells = [f"{t:>10.3f}{'*' if i == chosen else ' '}" for i, t in enumerate(times)]
+    print(f"{label:>18} " + ' '.join(cells))
+
+def bench_anagram(lengths: List[int], alphabet: str, label: str) -> None:
+    print(f'\n📊 validAnagram {label} (ms)  sorted / Counter / bincount')
+    for length in lengths:
+        str1 = ''.join(random.choices(alphabet, k=length))
+        str2 = ''.join(random.sample(str1, len(str1)))
+        times = [
+            measure(server.anagram_by_sorting, str1, str2),
+            measure(server.anagram_by_counter, str1, str2),
+            measure(server.anagram_by_bincount, str1, str2) if server.np is not None else float('nan'),
+        ]
+        if length < server.ANAGRAM_COUNT_MIN_LENGTH:
+            chosen = 0
+        elif server.np is not None:
+            chosen = 2
+        else:
+            chosen = 0 if length < server.ANAGRAM_COUNTER_MIN_LENGTH else 1
+        print_row(f'len={length}', times, chosen)
+
+def bench_sort(sizes: List[int], key_lengths: List[int]) -> None:
+    print('\n📊 sort (ms)  sorted / radix')
+    for size in sizes:
+        for key_length in key_lengths:
+            strArr = [''.join(random.choices(string.ascii_letters, k=random.randint(1, key_length))) for _ in range(size)]
+            times = [
+                measure(sorted, strArr),
+                measure(server.sort_radix_ascii, strArr) if server.np is not None else float('nan'),
+            ]
+            radix = (server.np is not None and size >= server.SORT_RADIX_MIN_ITEMS
+                     and key_length <= server.SORT_RADIX_MAX_LENGTH)
+            print_row(f'n={size} len<={key_length}', times, 1 if radix else 0)
+
+def bench_external_sort(sizes: List[int]) -> None:
+    print('\n📊 sort (ms)  sorted / external merge sort（メモリを抑える代わりに遅い）')
+    for size in sizes:
+        strArr = [''.join(random.choices(string.ascii_letters, k=16)) for _ in range(size)]
+        times = [
+            measure(sorted, strArr),
+            measure(server.sort_external, strArr, copy_list=True),
+        ]
+        print_row(f'n={size}', times, 1 if size >= server.SORT_EXTERNAL_MIN_ITEMS else 0)
+
+if __name__ == '__main__':
+    random.seed(0)
+    quick = len(sys.argv) > 1 and sys.argv[1] == 'quick'
+    if server.np is None:
+        print('⚠️ NumPyが無いのでbincount・基数ソートは測りません')
+    anagram_lengths = [n for n in ANAGRAM_LENGTHS if not quick or n <= 10000]
+    bench_anagram(anagram_lengths, string.ascii_letters + 'あいうえお', 'ASCII+かな')
+    # BMPの外の文字（絵文字）が混ざると、bincountはコードポイントの並べ替えに切り替わる
+    bench_anagram(anagram_lengths, string.ascii_letters + '😀', 'ASCII+絵文字')
+    bench_sort([n for n in SORT_SIZES if not quick or n <= 10000], SORT_KEY_LENGTHS)
+    bench_external_sort([n for n in EXTERNAL_SORT_SIZES if not quick or n <= 100000])
@@ -1,19 +1,15 @@
-import socket
-import os
-import json
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Tuple
 
-# TCP/IPのソケット(通信あり)を用意
-sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+# 接続・フレーム・ワイヤフォーマットの扱いはrpc_client.pyのRpcClientに任せる
+from rpc_client import RpcClient, SERVER_ADDRESS
 
-# サーバのアドレスを定義します。
-address = '/rpc_socket_file'
-
-print(f'🔌 サーバに接続中: {address}')
+print(f'🔌 サーバに接続中: {SERVER_ADDRESS}')
+# 対話で使うだけなので接続は1本でよい
+client = RpcClient(pool_size=1)
 try:
-    sock.connect(address)
+    codec = client.codec
     print('✅ 接続完了\n')
-except FileNotFoundError:
+except (FileNotFoundError, ConnectionRefusedError):
     print(f'❌ エラー: サーバーが起動していません')
     print(f'   先にサーバーを起動してください: python3 rpc/rpc-server.py')
     exit(1)
@@ -25,44 +21,52 @@ Args:
     method: 呼び出すメソッド名
     params: パラメータのリスト
     param_types: パラメータの型のリスト
-    request_id: リクエストID
 
 Returns:
     サーバからのレスポンス(辞書形式)
 """
-def call_rpc(
-    method: str,
-    params: List[Any],
-    param_types: List[str],
-    request_id: int = 1
-) -> Dict[str, Any]:
-    # リクエストを作成
-    request = {
-        "method": method,
-        "params": params,
-        "param_types": param_types,
-        "id": request_id
-    }
-
-    # JSON文字列に変換してバイト列にエンコード
-    message = json.dumps(request).encode('utf-8')
-
-    # サーバにメッセージを送信
-    print(f'📤 送信: {request}')
-    sock.send(message)
-
-    # サーバからの応答を待ち受け
+def call_rpc(method: str, params: List[Any], param_types: List[str]) -> Dict[str, Any]:
+    print(f'📤 送信: {method}({params})')
     print('⏳ レスポンス待機中...')
-    # 🔧 修正: recvfrom() → recv() に変更
-    data = sock.recv(4096)
-
-    # 受信したデータをJSON形式に変換
-    response = json.loads(data.decode('utf-8'))
+    response = client.request(method, params, param_types)
     print(f'📥 受信: {response}\n')
-
     return response
 
+"""
+複数のRPCをパイプラインで呼び出す
+レスポンスを待たずに全てのリクエストを送り、IDで突き合わせて受け取る
+
+Args:
+    calls: (method, params, param_types) のリスト
+
+Returns:
+    callsと同じ順番のレスポンスのリスト
+"""
+def call_pipelined(calls: List[Tuple[str, List[Any], List[str]]]) -> List[Dict[str, Any]]:
+    print(f'📤 {len(calls)}件のリクエストをまとめて送信')
+    responses = client.request_many(calls)
+    print(f'📥 {len(responses)}件のレスポンスを受信\n')
+    return responses
+
+"""
+複数のRPCをバッチで呼び出す
+全てのリクエストを1つのフレーム（JSONの配列）で送り、レスポンスも1つのフレームで受け取る
+サーバ側ではfloorをまとめて計算できる
+
+Args:
+    calls: (method, params, param_types) のリスト
+
+Returns:
+    callsと同じ順番のレスポンスのリスト
+"""
+def call_batch(calls: List[Tuple[str, List[Any], List[str]]]) -> List[Dict[str, Any]]:
+    print(f'📤 {len(calls)}件のリクエストをバッチで送信')
+    responses = client.request_many(calls, batch=True)
+    print(f'📥 {len(responses)}件のレスポンスを受信\n')
+    return responses
+
 try:
+    print(f'🤝 ワイヤフォーマット: {codec}')
     print("=" * 50)
     print("🎯 RPCクライアント")
     print("=" * 50)
@@ -72,19 +76,19 @@ try:
     print("3. reverse(string s) - 文字列を反転")
     print("4. validAnagram(string str1, string str2) - アナグラム判定")
     print("5. sort(string[] strArr) - 文字列配列をソート")
+    print("6. reverse をまとめて実行（パイプライン）")
+    print("7. floor をまとめて実行（バッチ）")
     print("0. 終了")
 
-    request_id = 1
-
     while True:
-        choice = input("\n関数を選択してください (0-5): ")
+        choice = input("\n関数を選択してください (0-7): ")
 
         if choice == "0":
             print("👋 終了します")
             break
         elif choice == "1":
             x = float(input("小数を入力してください: "))
-            response = call_rpc("floor", [x], ["double"], request_id)
+            response = call_rpc("floor", [x], ["double"])
             if "error" in response:
                 print(f"❌ エラー: {response['error']}")
             else:
@@ -92,14 +96,14 @@ try:
         elif choice == "2":
             n = int(input("n(乗数)を入力してください: "))
             x = int(input("x(値)を入力してください: "))
-            response = call_rpc("nroot", [n, x], ["int", "int"], request_id)
+            response = call_rpc("nroot", [n, x], ["int", "int"])
             if "error" in response:
                 print(f"❌ エラー: {response['error']}")
             else:
                 print(f"✅ 結果: {response['results']}")
         elif choice == "3":
             s = input("文字列を入力してください: ")
-            response = call_rpc("reverse", [s], ["string"], request_id)
+            response = call_rpc("reverse", [s], ["string"])
             if "error" in response:
                 print(f"❌ エラー: {response['error']}")
             else:
@@ -107,7 +111,7 @@ try:
         elif choice == "4":
             str1 = input("1つ目の文字列を入力してください: ")
             str2 = input("2つ目の文字列を入力してください: ")
-            response = call_rpc("validAnagram", [str1, str2], ["string", "string"], request_id)
+            response = call_rpc("validAnagram", [str1, str2], ["string", "string"])
             if "error" in response:
                 print(f"❌ エラー: {response['error']}")
             else:
@@ -115,16 +119,31 @@ try:
         elif choice == "5":
             arr_input = input("文字列をカンマ区切りで入力してください: ")
             arr = [s.strip() for s in arr_input.split(",")]
-            response = call_rpc("sort", [arr], ["string[]"], request_id)
+            response = call_rpc("sort", [arr], ["string[]"])
             if "error" in response:
                 print(f"❌ エラー: {response['error']}")
             else:
                 print(f"✅ 結果: {response['results']}")
+        elif choice == "6":
+            arr_input = input("文字列をカンマ区切りで入力してください: ")
+            calls = [("reverse", [s.strip()], ["string"]) for s in arr_input.split(",")]
+            responses = call_pipelined(calls)
+            for (_, params, _), response in zip(calls, responses):
+                if "error" in response:
+                    print(f"❌ {params[0]}: {response['error']}")
+                else:
+                    print(f"✅ {params[0]} → {response['results']}")
+        elif choice == "7":
+            arr_input = input("小数をカンマ区切りで入力してください: ")
+            calls = [("floor", [float(x)], ["double"]) for x in arr_input.split(",")]
+            responses = call_batch(calls)
+            for (_, params, _), response in zip(calls, responses):
+                if "error" in response:
+                    print(f"❌ {params[0]}: {response['error']}")
+                else:
+                    print(f"✅ {params[0]} → {response['results']}")
         else:
             print("❌ 無効な選択です")
-            continue
-
-        request_id += 1
 
 except KeyboardInterrupt:
     print("\n\n👋 Ctrl+Cで終了します")
@@ -136,4 +155,4 @@ except Exception as e:
 finally:
     # 最後にソケットを閉じてリソースを解放します
     print('\n🔒 ソケットをクローズします')
-    sock.close()
+    client.close()
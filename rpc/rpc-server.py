@@ -1,143 +1,870 @@
 import socket
 import os
+import sys
 import json
 import math
-from typing import Dict, Any, Callable, List
+import asyncio
+import heapq
+import inspect
+import tempfile
+import time
+import multiprocessing
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, Callable, List, Optional, Tuple, Union
 
-# TCP/IPのソケット(通信あり)を用意
-sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-
-# サーバが接続を待ち受けるUNIXドメインソケットのパスを指定します。
-address = '/rpc_socket_file'
+# NumPyがあればバッチ内のfloorをまとめて計算する（無ければ1件ずつ計算する）
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
+# msgpackがあればクライアントとの合意でJSONの代わりに使える（無ければJSONのみ）
 try:
-    # もし前回の実行でソケットファイルが残っていた場合、そのファイルを削除します。
-    os.unlink(address)
-except FileNotFoundError:
-    # ファイルが存在しない場合は何もしません。
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# サーバが接続を待ち受けるUNIXドメインソケットのパス
+SERVER_ADDRESS = '/rpc_socket_file'
+# 'asyncio': 複数の接続を同時に処理する / 'blocking': 1接続ずつ順番に処理する（引数で上書きできる）
+SERVER_MODE = 'asyncio'
+# accept待ちのキューの長さ
+LISTEN_BACKLOG = 128
+# 同時に処理する接続の上限（超えた分は空くまで待たせる）
+MAX_CONNECTIONS = 64
+# ワーカープールで処理中のリクエストの上限（超えたらその接続からの読み込みを止める）
+MAX_INFLIGHT_REQUESTS = 256
+# CPUを使う関数を実行するプロセス数
+MAX_WORKERS = os.cpu_count() or 1
+# ワーカープールに回す関数（イベントループを止めないように別プロセスで実行する）
+OFFLOAD_METHODS = {'sort', 'validAnagram'}
+# この大きさ以上のリクエストだけワーカープールに回す（小さいものはプロセス間の受け渡しの方が高くつく）
+OFFLOAD_MIN_BYTES = 64 * 1024
+# バッチ内で同じ関数の呼び出しがこの件数以上あればNumPyでまとめて計算する
+VECTORIZE_MIN_CALLS = 64
+# この絶対値を超える数はfloat64の整数として正確に表せないので、まとめて計算しない
+MAX_EXACT_INT = 2 ** 53
+
+# フレームの先頭に付けるJSONの長さ（4バイト・ビッグエンディアン）
+# recv()の区切りとリクエストの区切りは一致しないので、長さで1つのリクエストを切り出す
+FRAME_HEADER_SIZE = 4
+# 1つのフレームの最大サイズ（これを超える長さが来たら接続を切る）
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# 1回のrecv()で受け取る最大バイト数
+RECV_SIZE = 65536
+# ワイヤフォーマットを決めるメソッド。params[0]にクライアントが使いたい順のコーデック名を入れる
+NEGOTIATE_METHOD = 'rpc.negotiate'
+# validAnagramの計算方法を切り替える文字数（rpc-benchmark.pyで測った分岐点）
+# これより短ければsorted、長ければ文字ごとの出現数を比べる（NumPyがあればbincount、無ければCounter）
+ANAGRAM_COUNT_MIN_LENGTH = 128
+ANAGRAM_COUNTER_MIN_LENGTH = 256
+# bincountの表の大きさ（最大のコードポイント+1）が文字数のこの倍を超えたら、コードポイントを並べ替えて比べる
+# （絵文字のように大きなコードポイントが1文字でもあると、表を作るのに文字数と関係なく時間がかかる）
+ANAGRAM_BINCOUNT_TABLE_RATIO = 4
+# NumPyの基数ソート（1文字ずつ安定ソートを重ねる）を使う件数と、対象にする文字列の最大長
+# ASCIIの短い文字列がたくさんあるときだけsortedより速い
+SORT_RADIX_MIN_ITEMS = 10000
+SORT_RADIX_MAX_LENGTH = 16
+# この件数以上は一定数ずつソートしてファイルに書き出し、最後に併合する（入力と結果を同時に全部持たない）
+# 入力は1つのフレームで届くので、件数はMAX_FRAME_SIZEから決める（1件16バイト、JSONで12文字ほどなら約100万件届く）
+SORT_EXTERNAL_MIN_ITEMS = MAX_FRAME_SIZE // 16
+SORT_RUN_ITEMS = SORT_EXTERNAL_MIN_ITEMS // 4
+# 結果のキャッシュに残す件数・合計サイズ（見積もり）・秒数の上限
+RESULT_CACHE_MAX_ENTRIES = 4096
+RESULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+RESULT_CACHE_TTL = 300
+# msgpackの整数として送れる範囲（これを超える整数は文字列で返す）
+MIN_NATIVE_INT = -2 ** 63
+MAX_NATIVE_INT = 2 ** 64 - 1
+
+# 1. メソッドの登録（パラメータの確認と結果の変換は起動時に一度だけ用意する）
+class RpcError(Exception):
+    """そのままクライアントに返すエラー"""
     pass
 
-# ソケットが起動していることを表示します。
-print('starting up on {}'.format(address))
+# 関数の型注釈とparam_typesの名前の対応
+PARAM_TYPE_NAMES = {
+    float: 'double',
+    int: 'int',
+    str: 'string',
+    List[str]: 'string[]'
+}
+
+# 戻り値の型とresult_typeの名前の対応（param_typesと同じ名前を使う）
+RESULT_TYPE_NAMES = {
+    int: 'int',
+    float: 'double',
+    str: 'string',
+    bool: 'boolean',
+    list: 'string[]',
+    dict: 'object'
+}
+
+# param_typesごとの確認・変換関数（合わない値はTypeErrorにする）
+def check_double(value: Any) -> Any:
+    # boolはintのサブクラスなのでtypeで比べて除く
+    if type(value) is float or type(value) is int:
+        return value
+    raise TypeError
+
+def check_int(value: Any) -> int:
+    if type(value) is int:
+        return value
+    # 3.0のように整数の値を持つfloatは受け付ける
+    if type(value) is float and value.is_integer():
+        return int(value)
+    raise TypeError
+
+def check_string(value: Any) -> str:
+    if type(value) is str:
+        return value
+    raise TypeError
+
+def check_string_array(value: Any) -> List[str]:
+    if type(value) is list and all(type(item) is str for item in value):
+        return value
+    raise TypeError
+
+PARAM_CHECKERS = {
+    'double': check_double,
+    'int': check_int,
+    'string': check_string,
+    'string[]': check_string_array
+}
+
+# msgpackで型のまま届いたパラメータとして受け付ける型（変換はせず、typeで比べるだけ）
+NATIVE_PARAM_TYPES = {
+    'double': (float, int),
+    'int': (int,),
+    'string': (str,),
+    'string[]': (list,)
+}
+# string[]の要素として受け付ける型
+STRING_TYPES = {str}
+
+def result_type_name(result: Any) -> str:
+    """戻り値の実際の型からresult_typeの名前を決める"""
+    return RESULT_TYPE_NAMES.get(type(result), type(result).__name__)
+
+def to_native(result: Any) -> Any:
+    """msgpackでそのまま送れる値はそのまま、送れない値（複素数や大きすぎる整数）は文字列にする"""
+    if type(result) is int:
+        return result if MIN_NATIVE_INT <= result <= MAX_NATIVE_INT else str(result)
+    if type(result) in (float, bool, str, list, dict):
+        return result
+    return str(result)
 
-# sockオブジェクトのbindメソッドを使って、ソケットを特定のアドレスに関連付けます。
-# socketファイルはserver側にあるためserverでbindする
-sock.bind(address)
+class RpcMethod:
+    """登録済みのメソッド。関数の型注釈からパラメータの確認関数とresult_typeを用意しておく"""
+    def __init__(self, function: Callable, cache: bool = False):
+        signature = inspect.signature(function)
+        self.name = function.__name__
+        self.function = function
+        # Trueなら同じパラメータの結果をキャッシュから返す（副作用の無い関数だけ）
+        self.cache = cache
+        self.param_types = [PARAM_TYPE_NAMES[parameter.annotation] for parameter in signature.parameters.values()]
+        self.checkers = [PARAM_CHECKERS[param_type] for param_type in self.param_types]
+        self.native_types = [NATIVE_PARAM_TYPES[param_type] for param_type in self.param_types]
+        # 要素の型も確認するパラメータ（string[]）の位置
+        self.array_indexes = [index for index, param_type in enumerate(self.param_types) if param_type == 'string[]']
+        # List[str]のような注釈は実際の型（list）に直して比べる
+        return_type = getattr(signature.return_annotation, '__origin__', signature.return_annotation)
+        self.result_class = return_type
+        self.result_type = RESULT_TYPE_NAMES[return_type]
 
-# ソケットが接続要求を待機するようにします
-sock.listen(1)
+    def check_params(self, params: Any, param_types: Any) -> List[Any]:
+        """関数を実行する前にパラメータを確認する（合わなければ何もせずにエラーにする）"""
+        if type(params) is not list or len(params) != len(self.checkers):
+            raise RpcError(f"Invalid params: {self.name} takes {len(self.checkers)} params {self.param_types}")
+        # param_typesが送られてきた場合は宣言と一致するか確認する
+        if param_types is not None and param_types != self.param_types:
+            raise RpcError(f"Invalid param_types: {self.name} expects {self.param_types}, got {param_types}")
 
+        checked = []
+        for index, (checker, value) in enumerate(zip(self.checkers, params)):
+            try:
+                checked.append(checker(value))
+            except TypeError:
+                raise RpcError(f"Invalid param {index}: {self.name} expects {self.param_types[index]}, got {value!r:.50}")
+        return checked
+
+    def check_native_params(self, params: Any) -> Optional[List[Any]]:
+        """msgpackの接続でparam_typesが宣言どおりのときの確認（型を比べるだけで、1つずつの確認・変換はしない）
+        合わなければNoneを返す（check_paramsで変換するかエラーにする）"""
+        if type(params) is not list or len(params) != len(self.native_types):
+            return None
+        for value, types in zip(params, self.native_types):
+            if type(value) not in types:
+                return None
+        for index in self.array_indexes:
+            # 要素ごとにPythonの比較を回さず、型の集合で確認する
+            if not set(map(type, params[index])) <= STRING_TYPES:
+                return None
+        return params
+
+    def make_result(self, result: Any, request_id: int, native: bool = False) -> Dict[str, Any]:
+        """関数の戻り値をレスポンスにする（nativeなら結果を文字列にしない）"""
+        # 注釈どおりの型なら用意しておいた名前を使う（nrootの複素数のような例外だけ型を調べる）
+        result_type = self.result_type if type(result) is self.result_class else result_type_name(result)
+        return {
+            "results": to_native(result) if native else str(result),
+            "result_type": result_type,
+            "id": request_id
+        }
+
+    def __call__(self, *args):
+        return self.function(*args)
+
+# 登録済みのメソッド {method: RpcMethod}
+METHODS: Dict[str, RpcMethod] = {}
+
+def rpc_method(function: Optional[Callable] = None, *, cache: bool = False) -> Any:
+    """関数をRPCのメソッドとして登録するデコレータ（@rpc_method(cache=True)なら結果をキャッシュする）"""
+    def register(function: Callable) -> RpcMethod:
+        method = RpcMethod(function, cache)
+        METHODS[method.name] = method
+        return method
+
+    return register(function) if function is not None else register
+
+# 2. RPCで呼び出せる関数
 """10進数xを最も近い整数に切り捨て"""
+@rpc_method
 def floor(x: float) -> int:
     return math.floor(x)
 
 """方程式 r^n = x における、rの値を計算"""
+@rpc_method
 def nroot(n: int, x: int) -> float:
     return x ** (1 / n)
 
 """文字列sを入力として受け取り、入力文字列の逆である新しい文字列を返す"""
+@rpc_method
 def reverse(s: str) -> str:
     return s[::-1]
 
 """2つの文字列を入力として受け取り、2つの入力文字列が互いにアナグラムであるかどうかを示すブール値を返す"""
+@rpc_method(cache=True)
 def validAnagram(str1: str, str2: str) -> bool:
-    return sorted(str1) == sorted(str2)
+    # 長さが違えばアナグラムではない
+    if len(str1) != len(str2):
+        return False
+    if len(str1) < ANAGRAM_COUNT_MIN_LENGTH:
+        return anagram_by_sorting(str1, str2)
+    if np is not None:
+        return anagram_by_bincount(str1, str2)
+    if len(str1) < ANAGRAM_COUNTER_MIN_LENGTH:
+        return anagram_by_sorting(str1, str2)
+    return anagram_by_counter(str1, str2)
 
 """文字列の配列を入力として受け取り、その配列をソートして、ソート後の文字列の配列を返す"""
+@rpc_method(cache=True)
 def sort(strArr: List[str]) -> List[str]:
+    if len(strArr) >= SORT_EXTERNAL_MIN_ITEMS:
+        # 入力のリストは空になる（パラメータとして受け取ったリストなので他では使わない）
+        return sort_external(strArr)
+    if np is not None and len(strArr) >= SORT_RADIX_MIN_ITEMS and can_radix_sort(strArr):
+        return sort_radix_ascii(strArr)
     return sorted(strArr)
 
-# 2. 関数マッピングの作成
-def get_function_map() -> Dict[str, Callable]:
-    # 辞書を返す
-    return {
-        'floor': floor,
-        'nroot': nroot,
-        'reverse': reverse,
-        'validAnagram': validAnagram,
-        'sort': sort
+# validAnagram・sortの計算方法（入力の大きさで使い分ける）
+def anagram_by_sorting(str1: str, str2: str) -> bool:
+    """文字を並べ替えて比べる O(n log n)。短い文字列ではこれが一番速い"""
+    return sorted(str1) == sorted(str2)
+
+def anagram_by_counter(str1: str, str2: str) -> bool:
+    """文字ごとの出現数を比べる O(n)"""
+    return Counter(str1) == Counter(str2)
+
+def anagram_by_bincount(str1: str, str2: str) -> bool:
+    """コードポイントの出現数をNumPyで数えて比べる O(n)
+    大きなコードポイントがあって表が大きくなるときは、コードポイントを並べ替えて比べる O(n log n)"""
+    # UTF-32にすると1文字が1つのuint32になる
+    points1 = np.frombuffer(str1.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+    points2 = np.frombuffer(str2.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+    size = int(max(points1.max(), points2.max())) + 1
+    if size > len(points1) * ANAGRAM_BINCOUNT_TABLE_RATIO:
+        return bool(np.array_equal(np.sort(points1), np.sort(points2)))
+    return bool(np.array_equal(np.bincount(points1, minlength=size), np.bincount(points2, minlength=size)))
+
+def can_radix_sort(strArr: List[str]) -> bool:
+    """基数ソートで正しく並ぶ入力かどうか（NUL文字を含まない短いASCII文字列だけ）"""
+    joined = ''.join(strArr)
+    # 短い文字列の後ろはNULで埋めるので、NULを含む文字列があると順番が決まらない
+    # 空文字列だけのときは長さ0のバイト列（S0）の表を作れないのでsortedに任せる
+    return joined.isascii() and '\0' not in joined and 0 < max(map(len, strArr)) <= SORT_RADIX_MAX_LENGTH
+
+def sort_radix_ascii(strArr: List[str]) -> List[str]:
+    """ASCII文字列を1バイトずつの列にして、後ろの桁から安定ソートを重ねる（LSD基数ソート）"""
+    length = max(map(len, strArr))
+    # 固定長のバイト列にすると(件数, 長さ)のuint8の表として扱える
+    table = np.array(strArr, dtype=f'S{length}').view(np.uint8).reshape(len(strArr), length)
+    # lexsortは最後のキーが一番優先なので、先頭の文字が最後に来るように並べ替えて渡す
+    order = np.lexsort(table.T[::-1])
+    return [strArr[index] for index in order.tolist()]
+
+def sort_external(strArr: List[str]) -> List[str]:
+    """一定数ずつソートして一時ファイルに書き出し、heapq.mergeで少しずつ読みながら併合する"""
+    with tempfile.TemporaryDirectory(prefix='rpc-sort-') as directory:
+        paths = []
+        # 後ろから切り出して入力を縮めていく（先頭から消すと毎回リスト全体がずれる）
+        while strArr:
+            run = strArr[-SORT_RUN_ITEMS:]
+            del strArr[-SORT_RUN_ITEMS:]
+            run.sort()
+            path = os.path.join(directory, f'{len(paths)}.jsonl')
+            # 改行を含む文字列もあるのでJSON文字列として1行ずつ書く
+            with open(path, 'w', encoding='utf-8') as f:
+                f.writelines(json.dumps(item) + '\n' for item in run)
+            paths.append(path)
+            del run
+
+        files = [open(path, encoding='utf-8') for path in paths]
+        try:
+            return list(heapq.merge(*(map(json.loads, f) for f in files)))
+        finally:
+            for f in files:
+                f.close()
+
+"""結果のキャッシュのヒット数・ミス数などを返す"""
+@rpc_method
+def cacheStats() -> dict:
+    return result_cache.stats()
+
+# 3. 結果のキャッシュ
+def freeze(value: Any) -> Any:
+    """リストをタプルにして辞書のキーに使えるようにする"""
+    if type(value) is list:
+        return tuple(map(freeze, value))
+    return value
+
+def estimate_size(value: Any) -> int:
+    """キャッシュの上限に使うおおよそのメモリ量"""
+    if type(value) in (list, tuple):
+        return sys.getsizeof(value) + sum(map(estimate_size, value))
+    if type(value) is dict:
+        return sys.getsizeof(value) + sum(map(estimate_size, value.values()))
+    return sys.getsizeof(value)
+
+class ResultCache:
+    """メソッドとパラメータをキーにレスポンスを覚えておき、件数・サイズ・期限を超えたら古いものから捨てる"""
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # ワーカープロセスではFalseにする（結果はメインプロセスで覚える）
+        self.enabled = True
+        # {key: (response, 期限, サイズ)} 先頭ほど長く使われていない
+        self.entries: OrderedDict = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def key(self, request: Dict[str, Any], native: bool) -> Optional[tuple]:
+        """キャッシュするメソッドならキーを返す（型のまま返すかどうかでレスポンスが変わるのでキーに含める）"""
+        method = METHODS.get(request.get('method'))
+        if not self.enabled or method is None or not method.cache:
+            return None
+        params = request.get('params')
+        # 外部ソートするほど大きい入力はキャッシュしない（キーのタプルが入力の文字列を全て持ち続けてしまう）
+        if type(params) is list and any(type(value) is list and len(value) >= SORT_EXTERNAL_MIN_ITEMS for value in params):
+            return None
+        try:
+            key = (method.name, native, freeze(params), freeze(request.get('param_types')))
+            hash(key)
+        except TypeError:
+            # パラメータに辞書などが混ざっているものはキャッシュしない（確認でエラーになる）
+            return None
+        return key
+
+    def get(self, key: tuple) -> Optional[Dict[str, Any]]:
+        """覚えているレスポンスを返す（期限切れなら捨てる）"""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        response, expires_at, size = entry
+        if expires_at < time.monotonic():
+            self.remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return response
+
+    def put(self, key: tuple, response: Dict[str, Any]) -> None:
+        """レスポンスを覚える（エラーや上限より大きいものは覚えない）"""
+        if 'error' in response:
+            return
+        response = {"results": response["results"], "result_type": response["result_type"]}
+        size = estimate_size(key) + estimate_size(response)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.remove(key)
+        self.entries[key] = (response, time.monotonic() + self.ttl, size)
+        self.total_bytes += size
+        while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def remove(self, key: tuple) -> None:
+        _, _, size = self.entries.pop(key)
+        self.total_bytes -= size
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+result_cache = ResultCache(RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL)
+
+def cached_response(key: Optional[tuple], request_id: int) -> Optional[Dict[str, Any]]:
+    """キャッシュにあればIDを付けたレスポンスを返す"""
+    if key is None:
+        return None
+    response = result_cache.get(key)
+    if response is None:
+        return None
+    print(f'⚡ キャッシュから返します: {key[0]}')
+    return {**response, "id": request_id}
+
+def remember_response(key: Optional[tuple], response: Dict[str, Any]) -> None:
+    if key is not None:
+        result_cache.put(key, response)
+
+# 4. フレームの組み立てと切り出し
+def encode_frame(payload: bytes) -> bytes:
+    """長さ(4バイト) + 本体(JSONまたはmsgpack) のフレームを作る"""
+    return len(payload).to_bytes(FRAME_HEADER_SIZE, 'big') + payload
+
+def split_frames(buffer: bytearray) -> List[bytes]:
+    """バッファから完成したフレームを全て取り出す（途中のフレームはバッファに残る）"""
+    frames = []
+    offset = 0
+    while len(buffer) - offset >= FRAME_HEADER_SIZE:
+        size = int.from_bytes(buffer[offset:offset + FRAME_HEADER_SIZE], 'big')
+        if size > MAX_FRAME_SIZE:
+            raise ValueError(f"フレームが大きすぎます: {size} bytes")
+        end = offset + FRAME_HEADER_SIZE + size
+        if len(buffer) < end:
+            break
+        frames.append(bytes(buffer[offset + FRAME_HEADER_SIZE:end]))
+        offset = end
+    # 取り出した分はまとめて削除する（1フレームごとに削除するとコピーが増える）
+    del buffer[:offset]
+    return frames
+
+# 5. コーデックとレスポンスの送信
+class Codec:
+    """フレームの本体のワイヤフォーマット"""
+    def __init__(self, name: str, encode: Callable[[Any], bytes], decode: Callable[[bytes], Any], native_results: bool):
+        self.name = name
+        self.encode = encode
+        self.decode = decode
+        # Trueなら結果を文字列にせず、型のまま返す
+        self.native_results = native_results
+
+# 合意するまではJSONを使う（今までのクライアントはそのまま使える）
+JSON_CODEC = Codec('json', lambda obj: json.dumps(obj).encode('utf-8'), lambda data: json.loads(data.decode('utf-8')), False)
+
+def get_codecs() -> Dict[str, Codec]:
+    """使えるコーデック"""
+    codecs = {'json': JSON_CODEC}
+    if msgpack is not None:
+        codecs['msgpack'] = Codec(
+            'msgpack',
+            lambda obj: msgpack.packb(obj, use_bin_type=True),
+            lambda data: msgpack.unpackb(data, raw=False),
+            True
+        )
+    return codecs
+
+def is_negotiation(request: Any) -> bool:
+    """ワイヤフォーマットを決めるリクエストかどうか"""
+    return isinstance(request, dict) and request.get('method') == NEGOTIATE_METHOD
+
+def negotiate(request: Dict[str, Any]) -> Tuple[Dict[str, Any], Codec]:
+    """クライアントが挙げたコーデックのうち、最初に使えるものを選ぶ（無ければJSON）"""
+    params = request.get('params')
+    wanted = params[0] if isinstance(params, list) and params and isinstance(params[0], list) else []
+    codecs = get_codecs()
+    codec = next((codecs[name] for name in wanted if name in codecs), JSON_CODEC)
+    print(f'🤝 ワイヤフォーマット: {codec.name}')
+    response = {
+        "results": codec.name,
+        "result_type": RESULT_TYPE_NAMES[str],
+        "id": request.get('id', 0)
     }
+    if codec.native_results:
+        # 型のまま送る接続では、各メソッドのparam_typesを伝えて宣言どおりに送ってもらう（確認が速くなる）
+        response["methods"] = {name: {"param_types": method.param_types, "result_type": method.result_type}
+                               for name, method in METHODS.items()}
+    return response, codec
 
-# 3. レスポンス送信
-def send_response(connection, response: Dict[str, Any]) -> None:
-    """レスポンスを送信"""
-    json_response = json.dumps(response).encode('utf-8')
-    connection.send(json_response)
-    print(f'📤 送信: {response}')
+def encode_response(response: Union[Dict[str, Any], List[Dict[str, Any]]], codec: Codec) -> bytes:
+    """レスポンスをフレームにする"""
+    if isinstance(response, list):
+        print(f'📤 送信: {len(response)}件のバッチ')
+    else:
+        print(f'📤 送信: {response}')
+    return encode_frame(codec.encode(response))
 
-def send_error(connection, error_message: str, request_id: int) -> None:
-    """エラーレスポンスを送信"""
-    error_response = {
+def make_error(error_message: str, request_id: int) -> Dict[str, Any]:
+    """エラーレスポンスを作成"""
+    return {
         "error": error_message,
         "id": request_id
     }
-    send_response(connection, error_response)
 
-# 4. リクエスト処理
-def handle_request(connection, data: bytes) -> None:
-    """リクエストを処理"""
-    request_id = 0
+def make_exception_error(e: Exception, request_id: int) -> Dict[str, Any]:
+    """例外をエラーレスポンスにする"""
+    if isinstance(e, RpcError):
+        return make_error(str(e), request_id)
+    if isinstance(e, KeyError):
+        return make_error(f"Missing key: {e}", request_id)
+    return make_error(f"Server error: {e}", request_id)
 
-    try:
-        request = json.loads(data.decode('utf-8'))
+# 6. リクエスト処理
+def decode_request(data: bytes, codec: Codec) -> Union[Dict[str, Any], List[Any]]:
+    """フレームの中身をリクエスト（バッチの場合はリクエストのリスト）に変換"""
+    request = codec.decode(data)
+    if isinstance(request, list):
+        print(f'📥 受信: {len(request)}件のバッチ')
+    else:
         print(f'📥 受信: {request}')
+    return request
 
-        request_method = request['method']
-        request_id = request.get('id', 0)
-
-        # 関数マッピングから関数を取得
-        function_map = get_function_map()
-
-        # メソッドが存在するか確認
-        if request_method not in function_map:
-            send_error(connection, f"Unknown method: {request_method}", request_id)
-            return
+def lookup_method(request: Dict[str, Any]) -> RpcMethod:
+    """登録済みのメソッドからリクエストされたものを取得"""
+    method = METHODS.get(request['method'])
+    if method is None:
+        raise RpcError(f"Unknown method: {request['method']}")
+    return method
 
-        function = function_map[request_method]
+def execute_request(request: Dict[str, Any], native: bool = False) -> Dict[str, Any]:
+    """変換済みのリクエストをその場で実行してレスポンスを返す"""
+    request_id = request.get('id', 0)
+    key = result_cache.key(request, native)
+    response = cached_response(key, request_id)
+    if response is not None:
+        return response
 
+    try:
+        method = lookup_method(request)
+        params = None
+        if native and request.get('param_types') == method.param_types:
+            # msgpackで宣言どおりの型が届いていれば、型を比べるだけで済ませる
+            params = method.check_native_params(request['params'])
+        if params is None:
+            params = method.check_params(request['params'], request.get('param_types'))
         # 関数を実行 (*でparams[]の中身を展開して渡す)
-        result = function(*request['params'])
-
-        # 結果の型を判定
-        result_type = type(result).__name__
-        if result_type == 'list':
-            result_type = 'string[]'
-        elif result_type == 'float':
-            result_type = 'double'
-        elif result_type == 'bool':
-            result_type = 'boolean'
-
-        response = {
-            "results": str(result),
-            "result_type": result_type,
-            "id": request_id
-        }
+        response = method.make_result(method(*params), request_id, native)
+    except Exception as e:
+        return make_exception_error(e, request_id)
 
-        # 🔧 修正: connectionを渡す
-        send_response(connection, response)
+    remember_response(key, response)
+    return response
 
-    except KeyError as e:
-        send_error(connection, f"Missing key: {e}", request_id)
+def execute_any(request: Any, native: bool = False) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
+    """単独のリクエストでもバッチでも実行する
+    想定していない例外もエラーレスポンスにして、1つのリクエストでサーバや接続が落ちないようにする"""
+    try:
+        if isinstance(request, list):
+            return execute_batch(request, native)
+        if not isinstance(request, dict):
+            return make_error("Invalid request", 0)
+        return execute_request(request, native)
     except Exception as e:
-        send_error(connection, f"Server error: {e}", request_id)
+        return make_exception_error(e, request.get('id', 0) if isinstance(request, dict) else 0)
 
-# ソケットはデータの受信を永遠に待ち続けます。
-while True:
-    print('\nwaiting to receive message')
-    connection, client_address = sock.accept()
+# 7. バッチ処理
+# NumPyでまとめて計算しても1件ずつ計算したときと同じ結果になるパラメータかどうか
+# （bool・文字列・float64で正確に表せない大きな数は1件ずつ計算する）
+def can_vectorize_floor(params: Any) -> bool:
+    return (type(params) is list and len(params) == 1 and type(params[0]) in (int, float)
+            and -MAX_EXACT_INT < params[0] < MAX_EXACT_INT)
 
-    try:
-        print(f'✅ connection from {client_address}')
+def vector_floor(params_list: List[List[Any]]) -> List[Any]:
+    """floorをまとめて計算"""
+    values = np.array([params[0] for params in params_list], dtype=np.float64)
+    # tolist()でPythonのintに戻す（math.floorと同じ型にする）
+    return np.floor(values).astype(np.int64).tolist()
+
+def get_vector_function_map() -> Dict[str, tuple]:
+    """まとめて計算できる関数 {method: (パラメータの判定, 計算する関数, result_type)}"""
+    return {
+        # nrootはNumPyのpowが1件ずつの計算（x ** (1 / n)）と最後の桁でずれることがあるので、まとめて計算しない
+        'floor': (can_vectorize_floor, vector_floor, 'int')
+    }
 
-        while True:
-            data = connection.recv(4096)
+def execute_batch(requests: List[Any], native: bool = False) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
+    """バッチを実行してレスポンスのリストを返す（順番はリクエストと同じ）"""
+    if not requests:
+        return make_error("Empty batch", 0)
 
-            if data:
-                handle_request(connection, data)
+    vector_function_map = get_vector_function_map() if np is not None else {}
+    responses: List[Any] = [None] * len(requests)
+    # まとめて計算できる関数の呼び出し位置 {method: [index]}
+    groups: Dict[str, List[int]] = {}
+    for index, request in enumerate(requests):
+        if type(request) is not dict:
+            # バッチの入れ子は受け付けない
+            responses[index] = make_error("Invalid request", 0)
+        elif request.get('method') in vector_function_map:
+            groups.setdefault(request['method'], []).append(index)
+        else:
+            responses[index] = execute_request(request, native)
+
+    for method, indexes in groups.items():
+        can_vectorize, vector_function, result_type = vector_function_map[method]
+        param_types = METHODS[method].param_types
+        vector_indexes = []
+        for index in indexes:
+            request = requests[index]
+            if request.get('param_types') in (None, param_types) and can_vectorize(request.get('params')):
+                vector_indexes.append(index)
             else:
-                print('📪 no more data')
-                break
+                responses[index] = execute_request(requests[index], native)
+
+        if len(vector_indexes) < VECTORIZE_MIN_CALLS:
+            # 件数が少なければ配列を作る方が高くつく
+            for index in vector_indexes:
+                responses[index] = execute_request(requests[index], native)
+            continue
+
+        results = vector_function([requests[index]['params'] for index in vector_indexes])
+        for index, result in zip(vector_indexes, results):
+            # floorの結果はfloat64の範囲に収まるので、そのまま送れる
+            responses[index] = {
+                "results": result if native else str(result),
+                "result_type": result_type,
+                "id": requests[index].get('id', 0)
+            }
+
+    return responses
+
+# 8. ソケットの準備
+def create_server_socket() -> socket.socket:
+    """UNIXドメインソケットを作ってbind・listenする"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        # もし前回の実行でソケットファイルが残っていた場合、そのファイルを削除します。
+        os.unlink(SERVER_ADDRESS)
+    except FileNotFoundError:
+        # ファイルが存在しない場合は何もしません。
+        pass
+
+    # ソケットが起動していることを表示します。
+    print('starting up on {}'.format(SERVER_ADDRESS))
+
+    # socketファイルはserver側にあるためserverでbindする
+    sock.bind(SERVER_ADDRESS)
+    sock.listen(LISTEN_BACKLOG)
+    return sock
+
+# 9. 1接続ずつ処理するサーバ
+def serve_blocking() -> None:
+    """接続を1つずつ順番に処理する"""
+    sock = create_server_socket()
+
+    # ソケットはデータの受信を永遠に待ち続けます。
+    while True:
+        print('\nwaiting to receive message')
+        connection, client_address = sock.accept()
+
+        try:
+            print(f'✅ connection from {client_address}')
+
+            # 受信したバイト列をためておくバッファ（フレームの途中で切れていても次のrecvでつなげる）
+            buffer = bytearray()
+            codec = JSON_CODEC
+            while True:
+                data = connection.recv(RECV_SIZE)
+
+                if not data:
+                    print('📪 no more data')
+                    break
+
+                buffer += data
+                try:
+                    frames = split_frames(buffer)
+                except ValueError as e:
+                    connection.sendall(encode_response(make_error(str(e), 0), codec))
+                    break
+
+                # 届いているリクエストをまとめて処理し、レスポンスもまとめて返す（sendallが1回で済む）
+                payload = []
+                for frame in frames:
+                    try:
+                        request = decode_request(frame, codec)
+                    except Exception as e:
+                        payload.append(encode_response(make_exception_error(e, 0), codec))
+                        continue
+
+                    if is_negotiation(request):
+                        # 返事は今のコーデックで送り、次のフレームから切り替える
+                        response, next_codec = negotiate(request)
+                        payload.append(encode_response(response, codec))
+                        codec = next_codec
+                    else:
+                        payload.append(encode_response(execute_any(request, codec.native_results), codec))
+
+                if payload:
+                    connection.sendall(b''.join(payload))
+
+        finally:
+            connection.close()
+            print('🔒 connection closed')
+
+# 10. asyncioで複数の接続を同時に処理するサーバ
+# CPUを使う関数を実行するプロセスプール（起動時に作る）
+worker_pool = None
+
+def disable_result_cache() -> None:
+    """ワーカープロセスではキャッシュしない（メインプロセスで覚えるので二重に持たない）"""
+    result_cache.enabled = False
+
+def start_worker_pool() -> None:
+    """プロセスプールを作る。イベントループを持つプロセスをforkしないようにspawnで起動する"""
+    global worker_pool
+    worker_pool = ProcessPoolExecutor(
+        max_workers=MAX_WORKERS,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=disable_result_cache,
+    )
+
+def should_offload(request: Any, size: int) -> bool:
+    """ワーカープールに回すリクエストかどうか（大きいバッチも回す）"""
+    if size < OFFLOAD_MIN_BYTES:
+        return False
+    return isinstance(request, list) or (isinstance(request, dict) and request.get('method') in OFFLOAD_METHODS)
+
+def write_response(writer: asyncio.StreamWriter, response: Union[Dict[str, Any], List[Dict[str, Any]]], codec: Codec) -> None:
+    """レスポンスをフレームにして書き込む（実際の送信はdrainでまとめて行われる）"""
+    writer.write(encode_response(response, codec))
+
+async def offload_request(
+    request: Any,
+    key: Optional[tuple],
+    codec: Codec,
+    writer: asyncio.StreamWriter
+) -> None:
+    """ワーカープールでリクエストを実行し、終わった順にレスポンスを返す"""
+    request_id = request.get('id', 0) if isinstance(request, dict) else 0
+    try:
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(worker_pool, execute_any, request, codec.native_results)
+        remember_response(key, response)
+    except Exception as e:
+        response = make_exception_error(e, request_id)
+
+    if not writer.is_closing():
+        write_response(writer, response, codec)
+
+async def handle_client_async(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    connections: asyncio.Semaphore,
+    inflight: asyncio.Semaphore
+) -> None:
+    """1つの接続を処理する。パイプラインで届いたリクエストは終わった順に返す"""
+    async with connections:
+        print('✅ connection accepted')
+        # ワーカープールで実行中のリクエスト
+        tasks = set()
+        buffer = bytearray()
+        codec = JSON_CODEC
+        try:
+            while True:
+                data = await reader.read(RECV_SIZE)
+                if not data:
+                    print('📪 no more data')
+                    break
+
+                buffer += data
+                try:
+                    frames = split_frames(buffer)
+                except ValueError as e:
+                    write_response(writer, make_error(str(e), 0), codec)
+                    break
+
+                for frame in frames:
+                    try:
+                        request = decode_request(frame, codec)
+                    except Exception as e:
+                        write_response(writer, make_exception_error(e, 0), codec)
+                        continue
+
+                    if is_negotiation(request):
+                        # 返事は今のコーデックで送り、次のフレームから切り替える
+                        response, next_codec = negotiate(request)
+                        write_response(writer, response, codec)
+                        codec = next_codec
+                    elif should_offload(request, len(frame)):
+                        # ワーカーは結果を覚えないので、キャッシュはここで確認する
+                        key = None
+                        if isinstance(request, dict):
+                            key = result_cache.key(request, codec.native_results)
+                            response = cached_response(key, request.get('id', 0))
+                            if response is not None:
+                                write_response(writer, response, codec)
+                                continue
+                        # 処理中のリクエストが多すぎるときは空くまで次を読まない
+                        await inflight.acquire()
+                        task = asyncio.create_task(offload_request(request, key, codec, writer))
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+                        # 実行が始まる前にキャンセルされるとタスクのfinallyは動かないので、終わり方に関係なくここで返す
+                        task.add_done_callback(lambda _: inflight.release())
+                    else:
+                        write_response(writer, execute_any(request, codec.native_results), codec)
+
+                await writer.drain()
+
+            # クライアントが送信を終えても、処理中のリクエストには返事をする
+            if tasks:
+                await asyncio.gather(*tasks)
+            await writer.drain()
+        except ConnectionError as e:
+            print(f'❌ 接続エラー: {e}')
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+            print('🔒 connection closed')
+
+async def serve_asyncio() -> None:
+    """asyncioのストリームサーバで複数のクライアントを同時に処理する"""
+    connections = asyncio.Semaphore(MAX_CONNECTIONS)
+    inflight = asyncio.Semaphore(MAX_INFLIGHT_REQUESTS)
+    server = await asyncio.start_unix_server(
+        lambda reader, writer: handle_client_async(reader, writer, connections, inflight),
+        sock=create_server_socket(),
+    )
+    print(f'asyncioモードで起動しました: {SERVER_ADDRESS}')
+    async with server:
+        await server.serve_forever()
 
-    finally:
-        connection.close()
-        print('🔒 connection closed')
+if __name__ == '__main__':
+    mode = sys.argv[1] if len(sys.argv) > 1 else SERVER_MODE
+    if mode == 'asyncio':
+        start_worker_pool()
+        asyncio.run(serve_asyncio())
+    elif mode == 'blocking':
+        serve_blocking()
+    else:
+        print(f'不明なモードです: {mode} (asyncio または blocking)')
+        sys.exit(1)
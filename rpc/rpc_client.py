@@ -0,0 +1,336 @@
+import socket
+import json
+import time
+import asyncio
+import itertools
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError, InvalidStateError
+from typing import Any, Dict, List, Optional, Tuple
+
+# msgpackがあればサーバと合意してJSONの代わりに使う
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# サーバのアドレス
+SERVER_ADDRESS = '/rpc_socket_file'
+# フレームの先頭に付ける本体の長さ（4バイト・ビッグエンディアン）。サーバと合わせる
+FRAME_HEADER_SIZE = 4
+# 1回のrecv()で受け取る最大バイト数
+RECV_SIZE = 65536
+# プールに持つ接続の数（呼び出しは順番に振り分ける）
+POOL_SIZE = 4
+# 1回の呼び出しでレスポンスを待つ秒数
+CALL_TIMEOUT = 30
+# 接続が切れたりタイムアウトしたときにやり直す回数（サーバの関数は副作用が無いのでやり直せる）
+MAX_RETRIES = 2
+# やり直すまでに待つ秒数（やり直すたびに倍にする）
+RETRY_DELAY = 0.1
+# 使いたいワイヤフォーマット（先頭から順にサーバと合意を試み、どれも使えなければJSON）
+PREFERRED_CODECS = ['msgpack', 'json']
+# ワイヤフォーマットを決めるメソッド
+NEGOTIATE_METHOD = 'rpc.negotiate'
+
+# (method, params, param_types)
+Call = Tuple[str, List[Any], Optional[List[str]]]
+
+
+class RpcError(Exception):
+    """サーバがエラーを返した"""
+    pass
+
+
+def make_request(method: str, params: List[Any], param_types: Optional[List[str]], request_id: int) -> Dict[str, Any]:
+    """リクエストを作成"""
+    request = {
+        "method": method,
+        "params": params,
+        "id": request_id
+    }
+    if param_types is not None:
+        request["param_types"] = param_types
+    return request
+
+
+def split_frames(buffer: bytearray) -> List[bytes]:
+    """バッファから完成したフレームを全て取り出す（途中のフレームはバッファに残る）"""
+    frames = []
+    offset = 0
+    while len(buffer) - offset >= FRAME_HEADER_SIZE:
+        size = int.from_bytes(buffer[offset:offset + FRAME_HEADER_SIZE], 'big')
+        end = offset + FRAME_HEADER_SIZE + size
+        if len(buffer) < end:
+            break
+        frames.append(bytes(buffer[offset + FRAME_HEADER_SIZE:end]))
+        offset = end
+    del buffer[:offset]
+    return frames
+
+
+class RpcConnection:
+    """サーバへの1本の接続。受信用のスレッドがレスポンスをIDで待っているFutureに渡す"""
+
+    def __init__(self, address: str, request_ids: itertools.count, timeout: float):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(address)
+        self.sock.settimeout(None)
+        self.request_ids = request_ids
+        # 合意するまではJSON
+        self.codec = 'json'
+        # msgpackで合意したときにサーバが教えてくれる各メソッドのparam_types {method: param_types}
+        self.param_types: Dict[str, List[str]] = {}
+        # レスポンス待ちのリクエスト {id: Future}
+        self.pending: Dict[int, Future] = {}
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.closed = False
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+        try:
+            self.negotiate(timeout)
+        except Exception:
+            self.close()
+            raise
+
+    def encode(self, message: Any) -> bytes:
+        """メッセージをフレームにする"""
+        if self.codec == 'msgpack':
+            payload = msgpack.packb(message, use_bin_type=True)
+        else:
+            payload = json.dumps(message).encode('utf-8')
+        return len(payload).to_bytes(FRAME_HEADER_SIZE, 'big') + payload
+
+    def decode(self, payload: bytes) -> Any:
+        if self.codec == 'msgpack':
+            return msgpack.unpackb(payload, raw=False)
+        return json.loads(payload.decode('utf-8'))
+
+    def negotiate(self, timeout: float) -> None:
+        """ワイヤフォーマットを合意する（他のリクエストを送る前に1度だけ）"""
+        wanted = [name for name in PREFERRED_CODECS if name != 'msgpack' or msgpack is not None]
+        future, = self.submit([(NEGOTIATE_METHOD, [wanted], ["string[]"])])
+        response = future.result(timeout)
+        # 対応していないサーバはエラーを返すので、そのままJSONを使う
+        if 'error' not in response:
+            self.codec = response['results']
+            # param_typesを付けて送るとサーバは型を比べるだけで確認を済ませられる
+            self.param_types = {name: method['param_types'] for name, method in response.get('methods', {}).items()}
+
+    def submit(self, calls: List[Call], batch: bool = False) -> List[Future]:
+        """リクエストを送り、レスポンスを受け取るFutureを返す（batchなら1つのフレームで送る）"""
+        requests = [make_request(method, params,
+                                 param_types if param_types is not None else self.param_types.get(method),
+                                 next(self.request_ids))
+                    for method, params, param_types in calls]
+        # 送れない値（msgpackに入らない大きな整数など）で失敗しても待ち続けるFutureが残らないように、先に変換する
+        if batch:
+            data = self.encode(requests)
+        else:
+            data = b''.join(self.encode(request) for request in requests)
+
+        futures = [Future() for _ in requests]
+        # タイムアウトしたらpendingから外せるようにIDを覚えておく
+        for request, future in zip(requests, futures):
+            future.request_id = request['id']
+        with self.lock:
+            if self.closed:
+                raise ConnectionError('接続が閉じています')
+            for request, future in zip(requests, futures):
+                self.pending[request['id']] = future
+
+        try:
+            with self.send_lock:
+                self.sock.sendall(data)
+        except OSError as e:
+            self.fail(e)
+            raise ConnectionError(f'送信に失敗しました: {e}') from e
+        return futures
+
+    def forget(self, future: Future) -> None:
+        """待つのをやめたリクエストを忘れる"""
+        with self.lock:
+            self.pending.pop(getattr(future, 'request_id', None), None)
+
+    def read_loop(self) -> None:
+        """レスポンスを受信してIDの合うFutureに渡す（順不同で届いてよい）"""
+        buffer = bytearray()
+        try:
+            while True:
+                data = self.sock.recv(RECV_SIZE)
+                if not data:
+                    raise ConnectionError('サーバとの接続が切れました')
+                buffer += data
+                for payload in split_frames(buffer):
+                    message = self.decode(payload)
+                    for response in (message if isinstance(message, list) else [message]):
+                        with self.lock:
+                            future = self.pending.pop(response.get('id'), None)
+                        if future is not None:
+                            try:
+                                future.set_result(response)
+                            except InvalidStateError:
+                                # 呼び出し側が待つのをやめていた
+                                pass
+        except Exception as e:
+            self.fail(e)
+
+    def fail(self, error: Exception) -> None:
+        """接続を閉じ、待っている全てのリクエストをエラーにする"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            futures = list(self.pending.values())
+            self.pending.clear()
+        for future in futures:
+            try:
+                future.set_exception(ConnectionError(f'接続が切れました: {error}'))
+            except InvalidStateError:
+                pass
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def close(self) -> None:
+        self.fail(ConnectionError('クライアントが接続を閉じました'))
+
+
+class RpcClient:
+    """
+    接続プールを持つRPCクライアント
+    1本の接続で複数のリクエストを同時に送れる（レスポンスはIDで突き合わせる）ので、
+    スレッドやasyncioのタスクから何千件同時に呼び出しても接続はPOOL_SIZE本で済む
+
+    使い方:
+        with RpcClient() as client:
+            client.call('reverse', ['abc'])            # 'cba'
+            await client.call_async('floor', [1.5])    # asyncioから
+    """
+
+    def __init__(
+        self,
+        address: str = SERVER_ADDRESS,
+        pool_size: int = POOL_SIZE,
+        timeout: float = CALL_TIMEOUT,
+        retries: int = MAX_RETRIES
+    ):
+        self.address = address
+        self.timeout = timeout
+        self.retries = retries
+        self.request_ids = itertools.count(1)
+        # 接続は使うときに作る。切れたものは次に使うときに作り直す
+        self.connections: List[Optional[RpcConnection]] = [None] * pool_size
+        self.next_slot = itertools.count()
+        self.lock = threading.Lock()
+
+    def __enter__(self) -> 'RpcClient':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @property
+    def codec(self) -> str:
+        """最初の接続で合意したワイヤフォーマット"""
+        return self.connection().codec
+
+    def connection(self) -> RpcConnection:
+        """プールから接続を順番に選ぶ"""
+        slot = next(self.next_slot) % len(self.connections)
+        with self.lock:
+            connection = self.connections[slot]
+        if connection is not None and not connection.closed:
+            return connection
+        # 接続して合意の返事を待つ間に他の呼び出しを止めないように、ロックの外で作る
+        created = RpcConnection(self.address, self.request_ids, self.timeout)
+        with self.lock:
+            connection = self.connections[slot]
+            if connection is None or connection.closed:
+                connection = self.connections[slot] = created
+                created = None
+        if created is not None:
+            # 他のスレッドが先に作っていたらそちらを使う
+            created.close()
+        return connection
+
+    def submit(self, calls: List[Call], batch: bool = False) -> Tuple[RpcConnection, List[Future]]:
+        connection = self.connection()
+        return connection, connection.submit(calls, batch)
+
+    def request(self, method: str, params: List[Any], param_types: Optional[List[str]] = None,
+                timeout: Optional[float] = None) -> Dict[str, Any]:
+        """1件呼び出してレスポンス（辞書）をそのまま返す"""
+        return self.request_many([(method, params, param_types)], timeout=timeout)[0]
+
+    def call(self, method: str, params: List[Any], param_types: Optional[List[str]] = None,
+             timeout: Optional[float] = None) -> Any:
+        """1件呼び出して結果を返す（サーバがエラーを返したらRpcError）"""
+        return result_of(self.request(method, params, param_types, timeout))
+
+    def request_many(self, calls: List[Call], batch: bool = False,
+                     timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        複数のリクエストを返事を待たずにまとめて送り、callsと同じ順番でレスポンスを返す
+        batchなら1つのフレーム（JSONの配列）で送る（サーバ側でfloorをまとめて計算できる）
+        """
+        timeout = self.timeout if timeout is None else timeout
+        for attempt in range(self.retries + 1):
+            connection = None
+            futures: List[Future] = []
+            try:
+                connection, futures = self.submit(calls, batch)
+                deadline = time.monotonic() + timeout
+                return [future.result(max(0, deadline - time.monotonic())) for future in futures]
+            except (ConnectionError, FileNotFoundError, FutureTimeoutError) as e:
+                if connection is not None:
+                    for future in futures:
+                        connection.forget(future)
+                if attempt == self.retries:
+                    if isinstance(e, FutureTimeoutError):
+                        raise TimeoutError(f'{timeout}秒以内にレスポンスが届きませんでした') from e
+                    raise
+                time.sleep(RETRY_DELAY * 2 ** attempt)
+
+    async def request_async(self, method: str, params: List[Any], param_types: Optional[List[str]] = None,
+                            timeout: Optional[float] = None) -> Dict[str, Any]:
+        """asyncioから1件呼び出してレスポンス（辞書）を返す"""
+        timeout = self.timeout if timeout is None else timeout
+        calls = [(method, params, param_types)]
+        for attempt in range(self.retries + 1):
+            connection = None
+            future = None
+            try:
+                # 接続を作るときの合意の返事待ちやsendallはブロックするので、イベントループでは実行しない
+                connection, (future,) = await asyncio.get_running_loop().run_in_executor(None, self.submit, calls)
+                return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+            except (ConnectionError, FileNotFoundError, asyncio.TimeoutError) as e:
+                if connection is not None and future is not None:
+                    connection.forget(future)
+                if attempt == self.retries:
+                    if isinstance(e, asyncio.TimeoutError):
+                        raise TimeoutError(f'{timeout}秒以内にレスポンスが届きませんでした') from e
+                    raise
+                await asyncio.sleep(RETRY_DELAY * 2 ** attempt)
+
+    async def call_async(self, method: str, params: List[Any], param_types: Optional[List[str]] = None,
+                         timeout: Optional[float] = None) -> Any:
+        """asyncioから1件呼び出して結果を返す（サーバがエラーを返したらRpcError）"""
+        return result_of(await self.request_async(method, params, param_types, timeout))
+
+    def close(self) -> None:
+        with self.lock:
+            connections = [connection for connection in self.connections if connection is not None]
+            self.connections = [None] * len(self.connections)
+        for connection in connections:
+            connection.close()
+
+
+def result_of(response: Dict[str, Any]) -> Any:
+    """レスポンスから結果を取り出す"""
+    if 'error' in response:
+        raise RpcError(response['error'])
+    return response['results']
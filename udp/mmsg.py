@@ -0,0 +1,144 @@
+"""
+recvmmsgをctypesで呼び出し、UNIXドメインのデータグラムソケットから届いている分を1回のシステムコールでまとめて受け取る（Linux専用）
+使えない環境では1件ずつrecvfromする
+"""
+import ctypes
+import ctypes.util
+import errno
+import functools
+import os
+import socket
+import struct
+
+# struct sockaddr_un（ファミリー2バイト + パス108バイト）の大きさ
+SOCKADDR_UN_SIZE = 110
+# 1件でも届いたら待たずに返す（recvmmsgのフラグ）
+MSG_WAITFORONE = 0x10000
+# 受信した送信元をパスに変換した結果を覚えておく件数（同じ相手から何度も届くので）
+ADDRESS_CACHE_SIZE = 4096
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', msghdr),
+        ('msg_len', ctypes.c_uint),
+    ]
+
+
+def load_recvmmsg():
+    """libcのrecvmmsgを探す（無ければNone）"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        function = libc.recvmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    function.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    function.restype = ctypes.c_int
+    return function
+
+
+recvmmsg = load_recvmmsg()
+
+
+# 送信元が入れ替わり続けても増え続けないように、使われていないものから捨てる
+@functools.lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def unpack_sockaddr_un(name):
+    """struct sockaddr_unのバイト列をrecvfromと同じ形にする
+    （パスの文字列、抽象名前空間ならバイト列、bindしていない送信元ならNone）"""
+    path = name[2:]
+    if not path:
+        return None
+    if path[0] == 0:
+        return path
+    return os.fsdecode(path.split(b'\0', 1)[0])
+
+
+class Receiver:
+    """
+    1つのUNIXドメインのソケットからデータグラムをまとめて受け取る（スレッドごとに1つ作る）
+    受信用のバッファは作成時に用意して使い回す
+    """
+
+    def __init__(self, sock, batch, size):
+        self.sock = sock
+        self.batch = batch
+        self.size = size
+        self.messages = None
+        if recvmmsg is None or sock.family != socket.AF_UNIX:
+            return
+        self.buffers = ctypes.create_string_buffer(batch * size)
+        self.names = ctypes.create_string_buffer(batch * SOCKADDR_UN_SIZE)
+        self.iovs = (iovec * batch)()
+        self.messages = (mmsghdr * batch)()
+        self.view = memoryview(self.buffers).cast('B')
+        # mmsghdrのうちmsg_namelen（送信元のパスの長さで変わる）とmsg_lenだけを読む形式
+        namelen_offset = msghdr.msg_namelen.offset
+        length_offset = mmsghdr.msg_len.offset
+        self.length_format = struct.Struct(
+            f'{namelen_offset}xI{length_offset - namelen_offset - 4}xI{ctypes.sizeof(mmsghdr) - length_offset - 4}x')
+        buffers = ctypes.addressof(self.buffers)
+        names = ctypes.addressof(self.names)
+        for i in range(batch):
+            self.iovs[i].iov_base = buffers + i * size
+            self.iovs[i].iov_len = size
+            header = self.messages[i].msg_hdr
+            header.msg_name = names + i * SOCKADDR_UN_SIZE
+            header.msg_iov = ctypes.pointer(self.iovs[i])
+            header.msg_iovlen = 1
+            header.msg_namelen = SOCKADDR_UN_SIZE
+        # 前回受け取った件数（msg_namelenが書き換えられているので戻す）
+        self.last_count = 0
+
+    def recv(self):
+        """1件届くまで待ち、その時点で届いている分（最大batch件）を[(data, address), ...]で返す"""
+        if self.messages is None:
+            return self.recv_each()
+        for i in range(self.last_count):
+            self.messages[i].msg_hdr.msg_namelen = SOCKADDR_UN_SIZE
+        while True:
+            count = recvmmsg(self.sock.fileno(), ctypes.addressof(self.messages), self.batch, MSG_WAITFORONE, None)
+            if count >= 0:
+                break
+            error = ctypes.get_errno()
+            if error != errno.EINTR:
+                raise OSError(error, os.strerror(error))
+        # ctypesのフィールドを1つずつ読むと遅いので、受信した長さと送信元はまとめてバイト列から取り出す
+        lengths = self.length_format.iter_unpack(ctypes.string_at(ctypes.addressof(self.messages), count * ctypes.sizeof(mmsghdr)))
+        names = ctypes.string_at(ctypes.addressof(self.names), count * SOCKADDR_UN_SIZE)
+        self.last_count = count
+        received = []
+        for i, (namelen, length) in enumerate(lengths):
+            offset = i * self.size
+            name_offset = i * SOCKADDR_UN_SIZE
+            address = unpack_sockaddr_un(names[name_offset:name_offset + namelen])
+            received.append((self.view[offset:offset + length].tobytes(), address))
+        return received
+
+    def recv_each(self):
+        """recvmmsgが使えないときは、1件待ってから届いている分をノンブロッキングで読む"""
+        received = [self.sock.recvfrom(self.size)]
+        while len(received) < self.batch:
+            try:
+                received.append(self.sock.recvfrom(self.size, socket.MSG_DONTWAIT))
+            except (BlockingIOError, InterruptedError):
+                break
+        return received
@@ -1,6 +1,17 @@
 import socket
 import os
+import threading
 from faker import Faker
+# 届いているデータグラムをrecvmmsgでまとめて受け取る（同じディレクトリのmmsg.py）
+from mmsg import Receiver
+
+# 受信するスレッドの数（全員が同じソケットから読む）
+# UNIXドメインソケットではSO_REUSEPORTでソケットを分けられないので、1つのソケットを共有する
+UDP_WORKERS = 4
+# 1度に読み出す最大件数（1件待ってから、届いている分をrecvmmsgの1回のシステムコールでまとめて読む）
+RECV_BATCH = 64
+# 1件のデータグラムで受信できる最大バイト数
+RECV_SIZE = 4096
 
 # socket.socket関数を使用して、新しいソケットを作成します。
 # AF_UNIXはUNIXドメインソケットを表し、SOCK_DGRAMはデータグラムソケットを表します。
@@ -25,22 +36,35 @@ sock.bind(server_address)
 # Fakerインスタンス化
 faker = Faker()
 
-# ソケットはデータの受信を永遠に待ち続けます。
-while True:
-    print('\nwaiting to receive message')
-
-    # ソケットからのデータを受信します。
-    # 4096は一度に受信できる最大バイト数です。
-    data, address = sock.recvfrom(4096)
-
-    # 受信したデータのバイト数と送信元のアドレスを表示します。
-    print('received {} bytes from {}'.format(len(data), address))
-    print(data)
-
-    # 受信したデータをそのまま送信元に送り返します。
-    if data:
-        # message = faker.text().encode()
-        message = data
-        sent = sock.sendto(message, address)
-        # 送信したバイト数と送信先のアドレスを表示します。
-        print('sent {} bytes back to {}'.format(sent, address))
\ No newline at end of file
+def serve():
+    # 受信用のバッファはスレッドごとに用意して使い回す
+    receiver = Receiver(sock, RECV_BATCH, RECV_SIZE)
+    # ソケットはデータの受信を永遠に待ち続けます。
+    while True:
+        # ソケットからのデータをまとめて受信します。
+        received = receiver.recv()
+
+        # 受信した件数とバイト数を表示します（1件ごとに表示すると受信が追いつかなくなる）
+        print('received {} datagrams ({} bytes)'.format(len(received), sum(len(data) for data, _ in received)))
+
+        sent_total = 0
+        for data, address in received:
+            # 受信したデータをそのまま送信元に送り返します。
+            if data and address:
+                # message = faker.text().encode()
+                message = data
+                try:
+                    sent_total += sock.sendto(message, address)
+                except OSError as e:
+                    # 送信元のソケットが既に閉じられていた
+                    print('failed to send back to {}: {}'.format(address, e))
+        # 送信したバイト数を表示します。
+        print('sent {} bytes back'.format(sent_total))
+
+# 同じソケットを複数のスレッドで読む（recvfrom/sendtoの間はGILが外れる）
+workers = [threading.Thread(target=serve, daemon=True) for _ in range(UDP_WORKERS)]
+for worker in workers:
+    worker.start()
+print('waiting to receive message')
+for worker in workers:
+    worker.join()
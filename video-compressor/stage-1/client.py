@@ -1,40 +1,350 @@
 import socket
 import sys
 import os
+import time
+import json
+import errno
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # サーバーのアドレスを設定
 TCP_ADDRESS = ('localhost', 8080)
-# 1. ソケットを作る（サーバーと同じ）
-tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-tcp_sock.connect(TCP_ADDRESS)
-print(f"サーバーに接続しました: {TCP_ADDRESS}")
-
-# cliのコマンドからパス取得
-file_path = sys.argv[1]
-file_size = os.path.getsize(file_path)
-ext = os.path.splitext(file_path)
-if ext[1] != '.mp4':
-    print("拡張子が異なります")
-    exit()
-
-# ファイルサイズをまず送る
-tcp_sock.send(file_size.to_bytes(32, 'big'))
-
-# withでファイルを「安全に」開閉する
-try:
-    with open(file_path, 'rb') as f:
+# 1回の送信で渡す最大バイト数
+# sendfileでは1回のシステムコールで送る量、フォールバック時はsendallに渡すバッファの大きさになる
+CHUNK_SIZE = 4 * 1024 * 1024
+# この errno の場合はsendfileが使えないだけなので通常の送信に切り替える
+SENDFILE_FALLBACK_ERRNOS = (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP)
+# 並列に張る接続の数（python client.py <file> <streams> で変更できる）
+PARALLEL_STREAMS = 1
+# 並列アップロードで分割する範囲の境界（ページサイズの倍数にそろえる）
+RANGE_ALIGNMENT = 1024 * 1024
+# Trueなら範囲アップロードを使い、途中で切れてもサーバーにある続きから送り直す
+RESUMABLE_UPLOADS = True
+# 接続が切れたときに再開を試みる回数と、その間の待ち時間（秒）
+MAX_RETRIES = 5
+RETRY_DELAY = 2
+# アップロード後に使うエンコーダー（python client.py <file> <streams> <encoder>。'none'なら圧縮しない）
+ENCODER = 'h264'
+# 圧縮ジョブの完了を待つかどうかと、状態を問い合わせる間隔（秒）
+WAIT_FOR_JOB = True
+JOB_POLL_INTERVAL = 1
+# Trueならアップロードしながらサーバーでエンコードし、圧縮結果を同じ接続で受け取る（--stream でも有効）
+STREAMING_TRANSCODE = False
+
+# ヘッダー（32バイト）の1バイト目がオペレーション（サーバーと同じ定義）
+OP_UPLOAD = 0
+OP_UPLOAD_RANGE = 1
+OP_QUERY_UPLOAD = 2
+OP_LOOKUP = 3
+OP_COMPRESS = 4
+OP_JOB_STATUS = 5
+OP_STREAM_COMPRESS = 6
+STATUS_OK = 0
+
+
+def send_file_zero_copy(sock, f, offset, end):
+    """os.sendfileでファイルをカーネル内で直接ソケットへ送る。送り終えた位置を返す
+    sendfileが使えないと分かった場合も、それまでに送れた位置を返す"""
+    while offset < end:
+        # ユーザー空間へのコピーが発生しないので、Pythonのループは数回で済む
+        try:
+            sent = os.sendfile(sock.fileno(), f.fileno(), offset, min(CHUNK_SIZE, end - offset))
+        except OSError as e:
+            if e.errno not in SENDFILE_FALLBACK_ERRNOS:
+                raise
+            # 途中まで送れていることがあるので、続きの位置から通常の送信に切り替える
+            print("sendfileが使えないため通常の送信に切り替えます")
+            break
+        if sent == 0:
+            break
+        offset += sent
+    return offset
+
+
+def send_file_buffered(sock, f, offset, end):
+    """sendfileが使えない場合のフォールバック。大きなバッファをmemoryviewで切り出してsendallする"""
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    f.seek(offset)
+    while offset < end:
+        # readintoで同じバッファを使い回すので、チャンクごとのbytes生成が起きない
+        n = f.readinto(view[:min(CHUNK_SIZE, end - offset)])
+        if not n:
+            break
+        # sendallは短い書き込みがあっても全部送り切るまで繰り返してくれる
+        sock.sendall(view[:n])
+        offset += n
+    return offset
+
+
+def send_file(sock, f, offset, length):
+    """sendfile → memoryview + sendall の順で試してファイルのoffsetからlengthバイトを送信する"""
+    end = offset + length
+    position = offset
+    if hasattr(os, 'sendfile'):
+        position = send_file_zero_copy(sock, f, position, end)
+    if position < end:
+        # sendfileが途中で止まった場合や使えなかった場合も続きから送る
+        position = send_file_buffered(sock, f, position, end)
+    if position < end:
+        raise ConnectionError(f"送信が途中で終了しました: {position - offset}/{length} bytes")
+    return position - offset
+
+
+def recv_exact(sock, size):
+    """ちょうどsizeバイト受け取る"""
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("サーバーとの接続が切れました")
+        data += chunk
+    return data
+
+
+def recv_message(sock):
+    """JSON応答を受け取る: ヘッダー(ステータス1バイト + JSONサイズ31バイト) + JSON"""
+    header = recv_exact(sock, 32)
+    json_size = int.from_bytes(header[1:32], 'big')
+    return header[0], json.loads(recv_exact(sock, json_size))
+
+
+def upload_single(file_path, file_size):
+    """1本の接続でファイル全体を送る（従来の方式）。送ったバイト数を返す"""
+    # 1. ソケットを作る（サーバーと同じ）
+    tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp_sock.connect(TCP_ADDRESS)
+    print(f"サーバーに接続しました: {TCP_ADDRESS}")
+    try:
+        # ファイルサイズをまず送る
+        tcp_sock.sendall(file_size.to_bytes(32, 'big'))
+        # withでファイルを「安全に」開閉する
+        with open(file_path, 'rb') as f:
+            send_file(tcp_sock, f, 0, file_size)
+        # 送信成功した場合のみレスポンス受信
+        response = tcp_sock.recv(16)
+        print(f"Server response: {response.decode('utf-8')}")
+        return file_size
+    finally:
+        # 最後に接続を閉じる
+        tcp_sock.close()
+
+
+def send_request(tcp_sock, operation, params):
+    """ヘッダー(オペレーション1バイト + JSONサイズ31バイト) + JSON を送る"""
+    payload = json.dumps(params).encode('utf-8')
+    tcp_sock.sendall(bytes([operation]) + len(payload).to_bytes(31, 'big') + payload)
+
+
+def request(operation, params):
+    """データを伴わないオペレーションを1往復で実行して応答のJSONを返す"""
+    tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp_sock.connect(TCP_ADDRESS)
+    try:
+        send_request(tcp_sock, operation, params)
+        code, body = recv_message(tcp_sock)
+        if code != STATUS_OK:
+            raise RuntimeError(f"サーバーエラー: {body.get('error')}")
+        return body
+    finally:
+        tcp_sock.close()
+
+
+def upload_range(file_path, params, offset, length):
+    """範囲アップロード: ファイルのoffsetからlengthバイトを専用の接続で送る"""
+    tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp_sock.connect(TCP_ADDRESS)
+    try:
+        send_request(tcp_sock, OP_UPLOAD_RANGE, dict(params, offset=offset, length=length))
+        with open(file_path, 'rb') as f:
+            send_file(tcp_sock, f, offset, length)
+        code, body = recv_message(tcp_sock)
+        if code != STATUS_OK:
+            raise RuntimeError(f"範囲 {offset}-{offset + length} の送信に失敗しました: {body.get('error')}")
+        return body
+    finally:
+        tcp_sock.close()
+
+
+def file_upload_id(file_path, file_size):
+    """ファイルのパス・サイズ・更新時刻からupload_idを作る（再起動しても同じIDで再開できる）"""
+    stat = os.stat(file_path)
+    key = f"{os.path.abspath(file_path)}:{file_size}:{stat.st_mtime_ns}"
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def content_hash(file_path):
+    """ファイル全体のBLAKE2bハッシュを計算する（同じupload_idで中身が変わっていないかをサーバーが確認する）"""
+    digest = hashlib.blake2b(digest_size=32)
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(file_path, 'rb', buffering=0) as f:
         while True:
-            # TCPのプロトコルのセグメントは最大1460なので1400で安定して送る
-            chunk = f.read(1400)
-            if not chunk:
+            n = f.readinto(buffer)
+            if not n:
                 break
-            tcp_sock.send(chunk)
-    # 送信成功した場合のみレスポンス受信
-    response = tcp_sock.recv(16)
-    print(f"Server response: {response.decode('utf-8')}")
-except Exception as e:
-    print(f"処理エラー: {e}")
-
-finally:
-    # 最後に接続を閉じる
-    tcp_sock.close()
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+
+def split_ranges(missing, streams):
+    """まだサーバーにない範囲 [(offset, length)] を、およそstreams個の範囲に分割する"""
+    total = sum(length for _, length in missing)
+    part = -(-total // streams)
+    # 範囲の境界をそろえて、サーバー側の書き込みがページ境界に揃うようにする
+    part = max(RANGE_ALIGNMENT, -(-part // RANGE_ALIGNMENT) * RANGE_ALIGNMENT)
+    ranges = []
+    for start, length in missing:
+        end = start + length
+        ranges.extend((offset, min(part, end - offset)) for offset in range(start, end, part))
+    return ranges or [(0, 0)]
+
+
+def upload_ranges(file_path, file_size, digest, streams):
+    """ファイルを範囲に分けて、範囲ごとに別の接続で並列に送る
+    接続が切れたらサーバーに再開位置を問い合わせ、残りだけを送り直す。送ったバイト数を返す"""
+    params = {
+        "upload_id": file_upload_id(file_path, file_size),
+        "file_size": file_size,
+        "content_hash": digest,
+    }
+    sent = 0
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            if attempt > 0 and request(OP_LOOKUP, {"content_hash": digest})['exists']:
+                # 中断している間に別のクライアントが同じファイルを送り終えていた
+                print("Server response: already have it")
+                return sent
+            # サーバーにまだ無い範囲を問い合わせる
+            missing = request(OP_QUERY_UPLOAD, params)['missing']
+            remaining = sum(length for _, length in missing)
+            if remaining < file_size:
+                print(f"{file_size - remaining} bytes はサーバーにあるため、残り {remaining} bytes を送信します")
+            ranges = split_ranges(missing, streams)
+            print(f"{len(ranges)}本の接続で送信します (upload_id: {params['upload_id']})")
+            with ThreadPoolExecutor(max_workers=min(streams, len(ranges))) as executor:
+                futures = [
+                    executor.submit(upload_range, file_path, params, offset, length)
+                    for offset, length in ranges
+                ]
+                responses = [future.result() for future in futures]
+            sent += remaining
+            # 最後に書き終えた範囲の応答にコミット結果が入っている
+            for body in responses:
+                if body.get('status') == 'committed':
+                    print(f"Server response: committed ({body['filename']})")
+                    return sent
+            # 同じファイルを別のクライアントが同時に送っていると、そちらでコミットされることがある
+            found = request(OP_LOOKUP, {"content_hash": digest})
+            if found['exists']:
+                print(f"Server response: committed ({found['filename']})")
+                return sent
+            raise ConnectionError("全ての範囲を送信しましたが、まだコミットされていません")
+        except (OSError, ConnectionError) as e:
+            if attempt == MAX_RETRIES:
+                raise
+            print(f"接続エラー: {e}。{RETRY_DELAY}秒後に再開します ({attempt + 1}/{MAX_RETRIES})")
+            time.sleep(RETRY_DELAY)
+
+
+def compress(digest, encoder):
+    """サーバーに圧縮を依頼してジョブIDを表示し、WAIT_FOR_JOBなら完了まで待つ"""
+    job = request(OP_COMPRESS, {"content_hash": digest, "encoder": encoder})
+    print(f"圧縮ジョブID: {job['job_id']}")
+    while WAIT_FOR_JOB and job['state'] in ('queued', 'running'):
+        time.sleep(JOB_POLL_INTERVAL)
+        job = request(OP_JOB_STATUS, {"job_id": job['job_id']})
+    if job['state'] == 'done':
+        print(f"圧縮が完了しました: {job['output']}")
+    elif job['state'] == 'failed':
+        print(f"圧縮に失敗しました: {job['error']}")
+
+
+def stream_compress(file_path, file_size, encoder):
+    """ストリーミング圧縮: 送信しながら、サーバーから返ってくる圧縮結果をファイルに書き出す
+    送信と受信を別スレッドで行う（片方だけだとサーバー側のパイプが詰まって止まる）"""
+    output_path = f"{os.path.splitext(file_path)[0]}-{encoder}.mp4"
+    tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp_sock.connect(TCP_ADDRESS)
+    errors = []
+
+    def sender():
+        try:
+            with open(file_path, 'rb') as f:
+                send_file(tcp_sock, f, 0, file_size)
+        except OSError as e:
+            errors.append(e)
+
+    try:
+        send_request(tcp_sock, OP_STREAM_COMPRESS, {"file_size": file_size, "encoder": encoder})
+        # エンコーダーを起動できたという応答を待ってから送り始める
+        code, body = recv_message(tcp_sock)
+        if code != STATUS_OK:
+            raise RuntimeError(f"ストリーミング圧縮を開始できませんでした: {body.get('error')}")
+        sender_thread = threading.Thread(target=sender, daemon=True)
+        sender_thread.start()
+        received = 0
+        with open(output_path, 'wb') as out:
+            # [長さ(4バイト)][データ] の繰り返しを長さ0まで受け取る
+            while True:
+                size = int.from_bytes(recv_exact(tcp_sock, 4), 'big')
+                if size == 0:
+                    break
+                out.write(recv_exact(tcp_sock, size))
+                received += size
+        code, body = recv_message(tcp_sock)
+        sender_thread.join()
+        if code != STATUS_OK:
+            os.remove(output_path)
+            raise RuntimeError(f"ストリーミング圧縮に失敗しました: {body.get('error')}")
+        if errors:
+            raise errors[0]
+        print(f"圧縮結果を保存しました: {output_path} ({received} bytes)")
+        return file_size
+    finally:
+        tcp_sock.close()
+
+
+if __name__ == '__main__':
+    # cliのコマンドからパス取得（--で始まる引数はオプション）
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    file_path = args[0]
+    streams = int(args[1]) if len(args) > 1 else PARALLEL_STREAMS
+    encoder = args[2] if len(args) > 2 else ENCODER
+    streaming = STREAMING_TRANSCODE or '--stream' in sys.argv
+    file_size = os.path.getsize(file_path)
+    ext = os.path.splitext(file_path)
+    if ext[1] != '.mp4':
+        print("拡張子が異なります")
+        exit()
+
+    try:
+        digest = None
+        found = None
+        if not streaming:
+            # 大きなファイルではハッシュの計算に数秒かかるので、送信の時間とは別に表示する
+            hash_start = time.monotonic()
+            digest = content_hash(file_path)
+            print(f"ハッシュ計算: {time.monotonic() - hash_start:.3f}s")
+            # 送る前にハッシュで問い合わせ、サーバーが同じ内容を持っていれば何も送らない
+            found = request(OP_LOOKUP, {"content_hash": digest})
+        start = time.monotonic()
+        if streaming:
+            sent = stream_compress(file_path, file_size, encoder)
+        elif found['exists']:
+            print(f"Server response: already have it ({found['filename']})")
+            sent = 0
+        elif RESUMABLE_UPLOADS or streams > 1:
+            sent = upload_ranges(file_path, file_size, digest, streams)
+        else:
+            sent = upload_single(file_path, file_size)
+        elapsed = time.monotonic() - start
+        # スループットを表示（0除算を避ける）
+        throughput = sent / max(elapsed, 1e-9) / (1024 * 1024)
+        print(f"送信量: {sent} bytes, 時間: {elapsed:.3f}s, スループット: {throughput:.1f} MiB/s")
+        # ストリーミング圧縮では既に圧縮結果を受け取っている
+        if not streaming and encoder != 'none':
+            compress(digest, encoder)
+    except Exception as e:
+        print(f"処理エラー: {e}")
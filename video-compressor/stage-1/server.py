@@ -1,40 +1,1166 @@
 import socket
 import time
+import os
+import sys
+import json
+import hashlib
+import secrets
+import asyncio
+import threading
+import subprocess
+import multiprocessing
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-# TCPソケットを作成(TCPは作成->bind->listen->accept
-tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-tcp_address = ('localhost', 8080)
-# socketにIPアドレスとポートをバインド
-tcp_sock.bind(tcp_address)
-# tcpは待ち受ける数を指定する
-tcp_sock.listen(5)
-
-# tcpの処理
-while True:
-    # 接続を受け付ける tcpではbind→listen→accept→recvという手順が必要
-    client_socket, client_address = tcp_sock.accept()
-    print(f"TCP接続: {client_address}")
+# サーバーのアドレス
+TCP_ADDRESS = ('localhost', 8080)
+# 並行処理の方式: 'thread'(スレッドプール) または 'asyncio'（python server.py asyncio で切り替え）
+SERVER_MODE = 'thread'
+# listenのバックログ（acceptされるまでカーネルが保持する接続数）
+LISTEN_BACKLOG = 128
+# 同時に処理するアップロードの最大数（サーバー全体）
+MAX_CONNECTIONS = 64
+# 1接続あたりの上限: 受け付ける最大ファイルサイズと、無通信で待つ最大秒数
+MAX_FILE_SIZE = 16 * 1024 * 1024 * 1024
+CONNECTION_TIMEOUT = 60
+
+# 受信バッファの大きさ。ここが埋まるたびにまとめてファイルへ書き込む
+# ページサイズ(4096)の倍数にしておくと、最後以外の書き込みがすべて境界に揃う
+RECV_BUFFER_SIZE = 4 * 1024 * 1024
+
+# ヘッダー（32バイト）の1バイト目がオペレーション
+# 0: 通常アップロード（残り31バイトがファイルサイズ。従来の32バイトのファイルサイズと互換）
+# 1: 範囲アップロード（残り31バイトがJSONのサイズ。JSONの後に範囲のデータが続く）
+# 2: アップロード状況の問い合わせ（残り31バイトがJSONのサイズ。再開する位置を返す）
+# 3: ハッシュの問い合わせ（残り31バイトがJSONのサイズ。同じ内容のファイルを既に持っているかを返す）
+# 4: 圧縮の依頼（残り31バイトがJSONのサイズ。保存済みのファイルを圧縮するジョブを作りIDを返す）
+# 5: ジョブの状態の問い合わせ（残り31バイトがJSONのサイズ）
+# 6: ストリーミング圧縮（残り31バイトがJSONのサイズ。受信しながらエンコードし、結果を同じ接続で返す）
+OP_UPLOAD = 0
+OP_UPLOAD_RANGE = 1
+OP_QUERY_UPLOAD = 2
+OP_LOOKUP = 3
+OP_COMPRESS = 4
+OP_JOB_STATUS = 5
+OP_STREAM_COMPRESS = 6
+# JSONで返す応答のステータスコード（応答ヘッダーの1バイト目）
+STATUS_OK = 0
+STATUS_ERROR = 1
+# リクエストのJSONの最大サイズ
+MAX_JSON_SIZE = 64 * 1024
+# 範囲アップロードの途中のファイルを置くディレクトリ
+UPLOAD_DIR = 'uploads'
+# 途中までのアップロードを記録するインデックス（サーバーを再起動しても再開できるようにする）
+INDEX_PATH = os.path.join(UPLOAD_DIR, 'index.json')
+# この秒数より長く更新されていない途中のアップロードは起動時と定期的な確認のときに破棄する
+UPLOAD_EXPIRY = 7 * 24 * 60 * 60
+# 期限切れの途中のアップロードを確認する間隔（秒）
+UPLOAD_EXPIRY_INTERVAL = 60 * 60
+# 受信したファイルをハッシュ値のファイル名で保存するディレクトリ（同じ内容は1つだけ保存される）
+STORE_DIR = 'store'
+# 保存しておくファイルの上限。超えたら最後に使われたのが古いものから削除する
+MAX_STORE_BYTES = 100 * 1024 * 1024 * 1024
+MAX_STORE_FILES = 10000
+
+# 圧縮したファイルの保存先
+OUTPUT_DIR = 'output'
+# 同時に動かすエンコーダーの数（CPUのコア数まで）
+MAX_ENCODE_WORKERS = os.cpu_count() or 1
+# 終わったジョブの状態を覚えておく件数
+MAX_JOB_HISTORY = 1000
+# 使えるエンコーダー {名前: コマンド}。{input}と{output}がファイルのパスに置き換わる
+ENCODERS = {
+    'h264': ['ffmpeg', '-y', '-loglevel', 'error', '-i', '{input}',
+             '-c:v', 'libx264', '-preset', 'medium', '-crf', '28', '-c:a', 'aac', '-b:a', '128k',
+             '-f', 'mp4', '{output}'],
+    'h265': ['ffmpeg', '-y', '-loglevel', 'error', '-i', '{input}',
+             '-c:v', 'libx265', '-preset', 'medium', '-crf', '30', '-c:a', 'aac', '-b:a', '128k',
+             '-f', 'mp4', '{output}'],
+}
+DEFAULT_ENCODER = 'h264'
+# ストリーミング圧縮で使うエンコーダー（標準入力から読み、標準出力へ書く）
+# 出力はシークできないのでフラグメント化したmp4にする
+# 入力もシークできないので、moovが先頭にあるmp4（faststart済み）である必要がある
+STREAM_ENCODERS = {
+    'h264': ['ffmpeg', '-loglevel', 'error', '-i', 'pipe:0',
+             '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '28', '-c:a', 'aac', '-b:a', '128k',
+             '-movflags', 'frag_keyframe+empty_moov', '-f', 'mp4', 'pipe:1'],
+    'h265': ['ffmpeg', '-loglevel', 'error', '-i', 'pipe:0',
+             '-c:v', 'libx265', '-preset', 'veryfast', '-crf', '30', '-c:a', 'aac', '-b:a', '128k',
+             '-movflags', 'frag_keyframe+empty_moov', '-f', 'mp4', 'pipe:1'],
+}
+# エンコーダーの出力を送り返すときの1回の最大サイズ
+# 応答は「開始の応答(JSON)」→「[長さ(4バイト)][データ] の繰り返し（長さ0で終わり）」→「結果の応答(JSON)」の順
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# 範囲アップロードの状態を管理する辞書 {upload_id: RangeUpload}
+uploads = {}
+# 複数の接続から同じアップロードに書き込むためのロック
+uploads_lock = threading.Lock()
+
+
+class IncompleteTransfer(ConnectionError):
+    """範囲の途中で受信が止まったことを表す。receivedまではファイルに書き込み済み"""
+
+    def __init__(self, message, received):
+        super().__init__(message)
+        self.received = received
+
+
+def recv_exact(sock, size):
+    """ちょうどsizeバイト受け取る。途中で切断されたらConnectionErrorを投げる"""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError(f"ヘッダー受信中に切断されました: {received}/{size} bytes")
+        received += n
+    return bytes(buffer)
+
+
+def preallocate(fd, file_size):
+    """ディスク領域を先に確保しておく（断片化と書き込み中のENOSPCを防ぐ）"""
+    if file_size > 0 and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, file_size)
+        except OSError as e:
+            # fallocate非対応のファイルシステムでは確保せずにそのまま続ける
+            print(f"領域の事前確保をスキップします: {e}")
+
+
+def open_preallocated(path, file_size):
+    """書き込み用にファイルを作り、file_size分の領域を先に確保して返す（Pythonのバッファは使わない）"""
+    f = open(path, 'wb', buffering=0)
+    preallocate(f.fileno(), file_size)
+    return f
+
+
+def write_at(fd, view, offset):
+    """ファイルのoffsetの位置にviewを書き切る（pwriteは途中までしか書かないことがある）"""
+    written = 0
+    while written < len(view):
+        written += os.pwrite(fd, view[written:], offset + written)
+
+
+def write_chunk(fd, view, offset, digest):
+    """受信したデータを書き込み、digestがあればハッシュにも反映する"""
+    write_at(fd, view, offset)
+    if digest is not None:
+        digest.update(view)
+
+
+def new_digest():
+    """ファイルの内容を表すハッシュ（クライアントのcontent_hashと同じBLAKE2b-256）"""
+    return hashlib.blake2b(digest_size=32)
+
+
+def hash_file(path):
+    """ファイル全体のハッシュを計算する"""
+    digest = new_digest()
+    buffer = bytearray(RECV_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+
+def receive_into_file(sock, fd, offset, length, digest=None):
+    """再利用するバッファにrecv_intoで受信し、大きな単位でファイルのoffset以降へ書き込む
+    digestを渡すと、書き込むのと同時に受信した内容のハッシュも計算する"""
+    buffer = bytearray(RECV_BUFFER_SIZE)
+    view = memoryview(buffer)
+    received = 0
+    filled = 0
     try:
-        # 最初のファイルのバイト数を取得
-        file_size_data = client_socket.recv(32)
-        if len(file_size_data) < 32:
-            client_socket.close()
-            continue
-        file_size = int.from_bytes(file_size_data, 'big')
-        print(f"ファイルサイズ: {file_size}")
+        while received < length:
+            # バッファを埋める（残りがバッファより小さければその分だけ）
+            to_fill = min(RECV_BUFFER_SIZE, length - received)
+            filled = 0
+            while filled < to_fill:
+                n = sock.recv_into(view[filled:to_fill])
+                if n == 0:
+                    # 0バイトは相手が切断したという意味なので、進捗として数えずに中断する
+                    raise ConnectionError("相手が切断しました")
+                filled += n
+            write_chunk(fd, view[:filled], offset + received, digest)
+            received += filled
+            filled = 0
+    except OSError as e:
+        # 受信済みの分は書き込んでおき、再開時に送り直さなくて済むようにする
+        write_at(fd, view[:filled], offset + received)
+        received += filled
+        raise IncompleteTransfer(f"ファイル受信中に中断されました: {received}/{length} bytes ({e})", received) from e
+    return received
+
+
+def make_temp_path():
+    """受信中のファイルの一時的な保存先を作る"""
+    return os.path.join(UPLOAD_DIR, f"{secrets.token_hex(8)}.tmp")
+
+
+def send_status(sock, status):
+    """16バイトのステータスメッセージを送る"""
+    sock.sendall(status.ljust(16).encode('utf-8'))
+
+
+def encode_message(code, body):
+    """応答を組み立てる: ヘッダー(ステータス1バイト + JSONサイズ31バイト) + JSON"""
+    payload = json.dumps(body).encode('utf-8')
+    return bytes([code]) + len(payload).to_bytes(31, 'big') + payload
+
+
+def error_message(error):
+    """エラー応答を組み立てる"""
+    return encode_message(STATUS_ERROR, {"status": "error", "error": error})
+
+
+def parse_json_size(header):
+    """ヘッダーからJSONのサイズを取り出して上限を確認する"""
+    json_size = int.from_bytes(header[1:32], 'big')
+    if json_size > MAX_JSON_SIZE:
+        raise ValueError(f"JSONが大きすぎます: {json_size} bytes")
+    return json_size
+
+
+# --------------------------------------------------
+# ハッシュで管理する保存先（同じ内容のファイルは1つだけ保存する）
+# --------------------------------------------------
+class ContentStore:
+    """ハッシュ値をファイル名にして保存し、上限を超えたら最後に使われたのが古いものから削除する"""
+
+    def __init__(self, directory, max_bytes, max_files):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        # {digest: size} 先頭ほど長く使われていない
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        # 圧縮ジョブが読み込み中のファイルは削除しない {digest: 参照数}
+        self.pinned = {}
+        self.lock = threading.Lock()
+
+    def path(self, digest):
+        return os.path.join(self.directory, f"{digest}.mp4")
+
+    def load(self):
+        """起動時に保存済みのファイルを読み込む（更新時刻を最後に使われた時刻として並べる）"""
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for name in os.listdir(self.directory):
+            digest, ext = os.path.splitext(name)
+            if ext == '.mp4':
+                stat = os.stat(os.path.join(self.directory, name))
+                files.append((stat.st_mtime, digest, stat.st_size))
+        with self.lock:
+            for _, digest, size in sorted(files):
+                self.entries[digest] = size
+                self.total_bytes += size
+            self.evict()
+        print(f"保存済みのファイルを{len(self.entries)}件読み込みました")
+
+    def lookup(self, digest):
+        """保存済みならパスを返し、最後に使われた時刻を更新する"""
+        path = self.path(digest)
+        with self.lock:
+            if digest not in self.entries:
+                return None
+            # 再起動後も使われた順番がわかるように更新時刻を残しておく
+            # （addの削除と入れ違わないようにロック内で行う）
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # 外から消されていたら保存されていないものとして扱う
+                self.total_bytes -= self.entries.pop(digest)
+                return None
+            self.entries.move_to_end(digest)
+        return path
+
+    def add(self, temp_path, digest):
+        """受信し終えた一時ファイルを保存する。既に同じ内容があれば一時ファイルは捨てる"""
+        path = self.path(digest)
+        with self.lock:
+            if digest in self.entries:
+                os.remove(temp_path)
+                self.entries.move_to_end(digest)
+                print(f"同じ内容のファイルが既にあります: {path}")
+                return path
+            size = os.path.getsize(temp_path)
+            os.replace(temp_path, path)
+            self.entries[digest] = size
+            self.total_bytes += size
+            self.evict()
+        return path
+
+    def pin(self, digest):
+        """保存済みならパスを返し、unpinされるまで削除されないようにする"""
+        with self.lock:
+            if digest not in self.entries:
+                return None
+            self.entries.move_to_end(digest)
+            self.pinned[digest] = self.pinned.get(digest, 0) + 1
+        return self.path(digest)
+
+    def unpin(self, digest):
+        with self.lock:
+            count = self.pinned.pop(digest, 0) - 1
+            if count > 0:
+                self.pinned[digest] = count
+            self.evict()
+
+    def evict(self):
+        """上限を超えている間、一番長く使われていないファイルを削除する（lockを持った状態で呼ぶ）
+        追加したばかりのファイルと使用中のファイルは消さない"""
+        while self.total_bytes > self.max_bytes or len(self.entries) > self.max_files:
+            newest = next(reversed(self.entries))
+            digest = next((d for d in self.entries if d != newest and d not in self.pinned), None)
+            if digest is None:
+                break
+            size = self.entries.pop(digest)
+            self.total_bytes -= size
+            try:
+                os.remove(self.path(digest))
+            except FileNotFoundError:
+                pass
+            print(f"古いファイルを削除しました: {digest}")
+
+
+content_store = ContentStore(STORE_DIR, MAX_STORE_BYTES, MAX_STORE_FILES)
+
+
+def is_valid_digest(digest):
+    """ハッシュ値はファイル名に使うので64文字の16進数だけを受け付ける"""
+    return (isinstance(digest, str) and len(digest) == 64
+            and all(c in '0123456789abcdef' for c in digest))
+
+
+def lookup_content(params):
+    """クライアントが送る前に計算したハッシュで、同じ内容のファイルがあるかを返す"""
+    digest = params.get('content_hash')
+    if not is_valid_digest(digest):
+        raise ValueError("content_hashは64文字の16進数で指定してください")
+    path = content_store.lookup(digest)
+    if path is None:
+        return {"status": "success", "exists": False}
+    print(f"アップロード済みのファイルです: {path}")
+    return {"status": "success", "exists": True, "filename": path}
+
+
+# --------------------------------------------------
+# 範囲アップロード（1つのファイルを複数の接続で並列に受け取る）
+# --------------------------------------------------
+class RangeUpload:
+    """並列アップロード1件分の状態"""
+
+    def __init__(self, upload_id, file_size, content_hash, ranges=(), updated_at=None):
+        self.upload_id = upload_id
+        self.file_size = file_size
+        # クライアントが計算したファイル全体のハッシュ（同じupload_idで別のファイルが来たら作り直す）
+        self.content_hash = content_hash
+        self.path = os.path.join(UPLOAD_DIR, f"{upload_id}.part")
+        # 書き込みが完了した範囲のリスト [(start, end)]
+        self.ranges = [tuple(r) for r in ranges]
+        self.updated_at = updated_at or time.time()
+        # 書き込み中の接続数（0になるまでコミットしない）
+        self.active = 0
+        # ファイルディスクリプタは書き込み中の接続がある間だけ開いておく
+        self.fd = None
+
+    def open(self):
+        """途中のファイルを開く。新しいアップロードで全体の大きさを先に確保すべきならTrueを返す"""
+        if self.fd is not None:
+            return False
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        return not self.ranges
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def merged(self):
+        """重なったり隣り合ったりしている範囲をまとめたリストを返す"""
+        merged = []
+        for start, stop in sorted(self.ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+            else:
+                merged.append((start, stop))
+        return merged
+
+    def covered(self):
+        """書き込み済みのバイト数（重なった範囲は1回だけ数える）"""
+        return sum(stop - start for start, stop in self.merged())
+
+    def committed_offset(self):
+        """先頭から途切れずに書き込み済みのバイト数（単一の接続で再開するときの位置）"""
+        merged = self.merged()
+        return merged[0][1] if merged and merged[0][0] == 0 else 0
+
+    def missing(self):
+        """まだ書き込まれていない範囲のリスト [(offset, length)]"""
+        missing = []
+        position = 0
+        for start, stop in self.merged():
+            if start > position:
+                missing.append((position, start - position))
+            position = max(position, stop)
+        if position < self.file_size:
+            missing.append((position, self.file_size - position))
+        return missing
+
+    def to_index(self):
+        return {
+            "file_size": self.file_size,
+            "content_hash": self.content_hash,
+            "ranges": self.merged(),
+            "updated_at": self.updated_at,
+        }
+
+
+def save_index():
+    """途中のアップロードの状態をディスクに書き出す（uploads_lockを持った状態で呼ぶ）"""
+    index = {upload_id: upload.to_index() for upload_id, upload in uploads.items()}
+    tmp_path = INDEX_PATH + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    # 書き込み途中でサーバーが落ちても壊れたインデックスが残らないように置き換える
+    os.replace(tmp_path, INDEX_PATH)
+
+
+def load_index():
+    """起動時にインデックスを読み込み、途中のアップロードを復元する"""
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    # 通常アップロードの受信途中で落ちたときの一時ファイルは再開できないので削除する
+    for name in os.listdir(UPLOAD_DIR):
+        if name.endswith('.tmp'):
+            os.remove(os.path.join(UPLOAD_DIR, name))
+    try:
+        with open(INDEX_PATH) as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return
+    except ValueError as e:
+        print(f"インデックスを読み込めませんでした: {e}")
+        return
+    now = time.time()
+    with uploads_lock:
+        for upload_id, entry in index.items():
+            upload = RangeUpload(upload_id, entry['file_size'], entry.get('content_hash'),
+                                 entry.get('ranges', ()), entry.get('updated_at'))
+            expired = now - upload.updated_at > UPLOAD_EXPIRY
+            if expired or not os.path.exists(upload.path):
+                # 期限切れ、または途中のファイルが消えているものは破棄する
+                if os.path.exists(upload.path):
+                    os.remove(upload.path)
+                continue
+            uploads[upload_id] = upload
+        save_index()
+    print(f"途中のアップロードを{len(uploads)}件復元しました")
+
+
+def expire_uploads():
+    """UPLOAD_EXPIRYより長く更新されていない途中のアップロードを破棄する（書き込み中のものは残す）"""
+    now = time.time()
+    with uploads_lock:
+        expired = [upload for upload in uploads.values()
+                   if upload.active == 0 and now - upload.updated_at > UPLOAD_EXPIRY]
+        for upload in expired:
+            del uploads[upload.upload_id]
+            upload.close()
+            # 同じupload_idで新しいアップロードが始まる前に消しておく
+            try:
+                os.remove(upload.path)
+            except FileNotFoundError:
+                pass
+        if expired:
+            save_index()
+    for upload in expired:
+        print(f"期限切れのアップロードを破棄しました: {upload.upload_id}")
+
+
+def expire_uploads_forever():
+    """別スレッドで動かし、UPLOAD_EXPIRY_INTERVALごとに期限切れのアップロードを破棄する"""
+    while True:
+        time.sleep(UPLOAD_EXPIRY_INTERVAL)
+        try:
+            expire_uploads()
+        except OSError as e:
+            print(f"期限切れのアップロードを破棄できませんでした: {e}")
+
+
+def is_valid_upload_id(upload_id):
+    """upload_idはファイル名に使うので16進数の文字列だけを受け付ける"""
+    return (isinstance(upload_id, str) and 0 < len(upload_id) <= 64
+            and all(c in '0123456789abcdef' for c in upload_id))
+
+
+def parse_upload_params(params):
+    """upload_id, file_size, content_hash を取り出して検証する"""
+    upload_id = params.get('upload_id')
+    file_size = params.get('file_size')
+    content_hash = params.get('content_hash')
+    if not is_valid_upload_id(upload_id):
+        raise ValueError(f"不正なupload_idです: {upload_id}")
+    if not isinstance(file_size, int) or file_size < 0:
+        raise ValueError("file_sizeは0以上の整数で指定してください")
+    if file_size > MAX_FILE_SIZE:
+        raise ValueError("ファイルサイズが上限を超えています")
+    if content_hash is not None and not is_valid_digest(content_hash):
+        raise ValueError("content_hashは64文字の16進数で指定してください")
+    return upload_id, file_size, content_hash
+
+
+def find_upload(upload_id, file_size, content_hash):
+    """同じファイルの途中のアップロードを探す（uploads_lockを持った状態で呼ぶ）
+    upload_idが同じでもファイルサイズやハッシュが違う場合は古い状態を捨てる"""
+    upload = uploads.get(upload_id)
+    if upload is None:
+        return None
+    if upload.file_size == file_size and upload.content_hash == content_hash:
+        return upload
+    if upload.active > 0:
+        raise ValueError("同じupload_idで別のファイルを送信中です")
+    upload.close()
+    if os.path.exists(upload.path):
+        os.remove(upload.path)
+    del uploads[upload_id]
+    return None
+
+
+def query_upload(params):
+    """アップロードの再開位置を返す。未知のアップロードなら0から"""
+    upload_id, file_size, content_hash = parse_upload_params(params)
+    with uploads_lock:
+        upload = find_upload(upload_id, file_size, content_hash)
+        if upload is None:
+            return {"status": "success", "upload_id": upload_id, "offset": 0, "missing": [[0, file_size]]}
+        return {
+            "status": "success",
+            "upload_id": upload_id,
+            "offset": upload.committed_offset(),
+            "missing": upload.missing(),
+        }
+
+
+def begin_range(params):
+    """範囲アップロードを開始する。(RangeUpload, offset, length) を返す"""
+    upload_id, file_size, content_hash = parse_upload_params(params)
+    offset = params.get('offset')
+    length = params.get('length')
+    if not all(isinstance(v, int) and v >= 0 for v in (offset, length)):
+        raise ValueError("offset, lengthは0以上の整数で指定してください")
+    if offset + length > file_size:
+        raise ValueError(f"範囲がファイルサイズを超えています: {offset}+{length} > {file_size}")
+
+    with uploads_lock:
+        upload = find_upload(upload_id, file_size, content_hash)
+        if upload is None:
+            upload = RangeUpload(upload_id, file_size, content_hash)
+            uploads[upload_id] = upload
+        allocate = upload.open()
+        upload.active += 1
+    if allocate:
+        # 大きなファイルでは時間がかかるので、他のアップロードを止めないようにロックの外で確保する
+        # （activeを増やしてあるのでファイルは閉じられず、他の接続が書き込んだ部分は壊さない）
+        preallocate(upload.fd, upload.file_size)
+    return upload, offset, length
+
+
+def finish_range(upload, offset, length, received):
+    """範囲の受信が終わったときに呼ぶ（receivedは書き込めたバイト数）
+    全範囲がそろったらファイルを確定して保存先のパスを返す"""
+    if received > 0:
+        # インデックスに記録する前に、書き込んだ内容を確実にディスクへ反映する
+        os.fsync(upload.fd)
+    with uploads_lock:
+        upload.active -= 1
+        if received > 0:
+            upload.ranges.append((offset, offset + received))
+            upload.updated_at = time.time()
+        if upload.active > 0:
+            save_index()
+            return None
+        if upload.covered() < upload.file_size:
+            # 続きは再接続してから送られてくるので、ファイルは閉じておく
+            upload.close()
+            save_index()
+            return None
+        # 最後の範囲を書き終えた接続がコミットする
+        del uploads[upload.upload_id]
+        upload.close()
+        # 同じupload_idで次のアップロードが始まっても別のファイルになるように、ロック内で移動しておく
+        commit_path = make_temp_path()
+        os.replace(upload.path, commit_path)
+        save_index()
+    # 範囲は順不同で届くので、受信しながらではなく全体がそろってからハッシュを計算する
+    digest = hash_file(commit_path)
+    if upload.content_hash is not None and digest != upload.content_hash:
+        os.remove(commit_path)
+        raise ValueError(f"ハッシュが一致しません: {digest}")
+    return content_store.add(commit_path, digest)
+
+
+def range_response(upload, filename):
+    """範囲アップロードの応答を作る"""
+    if filename is not None:
+        print(f"アップロードを確定しました: {upload.upload_id} -> {filename}")
+        return {"status": "committed", "upload_id": upload.upload_id, "filename": filename}
+    return {"status": "success", "upload_id": upload.upload_id}
+
+
+# --------------------------------------------------
+# 圧縮ジョブ（エンコーダーは別プロセスで動かし、受信処理を止めない）
+# --------------------------------------------------
+def run_encoder(command, input_path, output_path):
+    """ワーカープロセスで実行される。エンコーダーを起動して出力ファイルを作る"""
+    # 書き込み途中のファイルが出力として見えないように、一時ファイルに書いてから置き換える
+    temp_path = output_path + '.tmp'
+    argv = [arg.replace('{input}', input_path).replace('{output}', temp_path) for arg in command]
+    try:
+        result = subprocess.run(argv, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise RuntimeError(f"エンコーダーが見つかりません: {argv[0]}")
+    if result.returncode != 0:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        stderr = result.stderr.decode('utf-8', errors='replace')[-500:]
+        raise RuntimeError(f"エンコードに失敗しました (終了コード {result.returncode}): {stderr}")
+    os.replace(temp_path, output_path)
+    return output_path
+
+
+class CompressJob:
+    """圧縮ジョブ1件分の状態"""
+
+    def __init__(self, job_id, digest, encoder, output_path):
+        self.job_id = job_id
+        self.digest = digest
+        self.encoder = encoder
+        self.output_path = output_path
+        # 出力が既にある場合はエンコーダーを動かさないのでNoneのまま
+        self.future = None
+
+    def state(self):
+        if self.future is None:
+            return 'done'
+        if not self.future.done():
+            return 'running' if self.future.running() else 'queued'
+        return 'failed' if self.future.exception() is not None else 'done'
+
+    def to_status(self):
+        status = {"status": "success", "job_id": self.job_id, "state": self.state()}
+        if status['state'] == 'done':
+            status['output'] = self.output_path
+        elif status['state'] == 'failed':
+            status['error'] = str(self.future.exception())
+        return status
+
+
+# ジョブの状態 {job_id: CompressJob}（古いものから消す）
+jobs = OrderedDict()
+# 実行中のジョブ {(digest, encoder): job_id}（同じ依頼が重なったら同じジョブを返す）
+active_jobs = {}
+jobs_lock = threading.Lock()
+# エンコーダーを動かすプロセスプール（起動時に作る）
+encoder_pool = None
+
+
+def start_encoder_pool():
+    """プロセスプールを作る。スレッドを持つサーバープロセスをforkしないようにspawnで起動する"""
+    global encoder_pool
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    encoder_pool = ProcessPoolExecutor(
+        max_workers=MAX_ENCODE_WORKERS,
+        mp_context=multiprocessing.get_context('spawn'),
+    )
+
+
+def remember_job(job):
+    """ジョブを登録し、終わったジョブが多すぎたら古いものから忘れる（jobs_lockを持った状態で呼ぶ）"""
+    jobs[job.job_id] = job
+    while len(jobs) > MAX_JOB_HISTORY:
+        oldest = next((job_id for job_id, j in jobs.items() if j.state() in ('done', 'failed')), None)
+        if oldest is None:
+            break
+        del jobs[oldest]
+
+
+def finish_job(job):
+    """エンコーダーが終わったときに呼ばれる"""
+    content_store.unpin(job.digest)
+    with jobs_lock:
+        active_jobs.pop((job.digest, job.encoder), None)
+    if job.future.exception() is not None:
+        print(f"圧縮ジョブが失敗しました: {job.job_id}: {job.future.exception()}")
+    else:
+        print(f"圧縮ジョブが完了しました: {job.job_id} -> {job.output_path}")
+
+
+def submit_compress(params):
+    """保存済みのファイルを圧縮するジョブを作ってジョブIDを返す"""
+    digest = params.get('content_hash')
+    encoder = params.get('encoder', DEFAULT_ENCODER)
+    if not is_valid_digest(digest):
+        raise ValueError("content_hashは64文字の16進数で指定してください")
+    if encoder not in ENCODERS:
+        raise ValueError(f"不明なエンコーダーです: {encoder} ({', '.join(ENCODERS)})")
+    output_path = os.path.join(OUTPUT_DIR, f"{digest}-{encoder}.mp4")
+
+    with jobs_lock:
+        job_id = active_jobs.get((digest, encoder))
+        if job_id is not None:
+            return jobs[job_id].to_status()
+        job = CompressJob(secrets.token_hex(16), digest, encoder, output_path)
+        if not os.path.exists(output_path):
+            # エンコードが終わるまで入力のファイルが削除されないようにする
+            input_path = content_store.pin(digest)
+            if input_path is None:
+                raise ValueError("ファイルがありません。先にアップロードしてください")
+            job.future = encoder_pool.submit(run_encoder, ENCODERS[encoder], input_path, output_path)
+            active_jobs[(digest, encoder)] = job.job_id
+        remember_job(job)
+    if job.future is not None:
+        # すぐに終わった場合はこの場で呼ばれるので、ロックを外してから登録する
+        job.future.add_done_callback(lambda _: finish_job(job))
+        print(f"圧縮ジョブを登録しました: {job.job_id} ({encoder})")
+    return job.to_status()
+
+
+def job_status(params):
+    """ジョブの状態を返す"""
+    job_id = params.get('job_id')
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is None:
+        raise ValueError(f"不明なジョブです: {job_id}")
+    return job.to_status()
+
+
+# --------------------------------------------------
+# ストリーミング圧縮（受信とエンコードを並行して行う）
+# --------------------------------------------------
+def parse_stream_params(params):
+    """ストリーミング圧縮のパラメータを検証して (file_size, command) を返す"""
+    file_size = params.get('file_size')
+    encoder = params.get('encoder', DEFAULT_ENCODER)
+    if not isinstance(file_size, int) or file_size < 0:
+        raise ValueError("file_sizeは0以上の整数で指定してください")
+    if file_size > MAX_FILE_SIZE:
+        raise ValueError("ファイルサイズが上限を超えています")
+    if encoder not in STREAM_ENCODERS:
+        raise ValueError(f"不明なエンコーダーです: {encoder} ({', '.join(STREAM_ENCODERS)})")
+    return file_size, STREAM_ENCODERS[encoder]
+
+
+def stream_result(returncode, stderr, received, sent):
+    """ストリーミング圧縮の最後に送る応答を作る"""
+    if returncode != 0:
+        stderr = stderr.decode('utf-8', errors='replace')[-500:]
+        return error_message(f"エンコードに失敗しました (終了コード {returncode}): {stderr}")
+    print(f"ストリーミング圧縮が完了しました: {received} bytes -> {sent} bytes")
+    return encode_message(STATUS_OK, {"status": "success", "received": received, "sent": sent})
+
+
+def write_all(fd, view):
+    """パイプにviewを書き切る。パイプがいっぱいの間はここで止まり、それ以上受信しなくなる"""
+    written = 0
+    while written < len(view):
+        written += os.write(fd, view[written:])
+
+
+def pump_encoder_output(proc, sock, counter):
+    """エンコーダーの標準出力を読み、長さ付きのチャンクにしてクライアントへ送る
+    クライアントの受信が遅いとsendallで止まり、エンコーダーも出力パイプがいっぱいになって止まる"""
+    fd = proc.stdout.fileno()
+    try:
+        while True:
+            chunk = os.read(fd, STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            sock.sendall(len(chunk).to_bytes(4, 'big'))
+            sock.sendall(chunk)
+            counter[0] += len(chunk)
+        sock.sendall((0).to_bytes(4, 'big'))
+    except OSError as e:
+        # 送り返せなくなったらエンコーダーを止める（受信側のスレッドが書き込みで止まったままにならないように）
+        print(f"エンコーダーの出力を送信できませんでした: {e}")
+        proc.kill()
+
+
+def handle_stream_compress(client_socket, header):
+    """受信したデータをそのままエンコーダーの標準入力に流し込み、出力を同じ接続で送り返す"""
+    params = json.loads(recv_exact(client_socket, parse_json_size(header)))
+    try:
+        file_size, command = parse_stream_params(params)
+    except ValueError as e:
+        client_socket.sendall(error_message(str(e)))
+        return
+    # stderrはパイプにすると読み出さない間に詰まるので一時ファイルに書かせる
+    with tempfile.TemporaryFile() as stderr_file:
+        try:
+            proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr_file)
+        except FileNotFoundError:
+            client_socket.sendall(error_message(f"エンコーダーが見つかりません: {command[0]}"))
+            return
+        # 開始できることを伝えてから、クライアントにデータを送ってもらう
+        client_socket.sendall(encode_message(STATUS_OK, {"status": "accepted"}))
+        sent = [0]
+        output_thread = threading.Thread(target=pump_encoder_output, args=(proc, client_socket, sent), daemon=True)
+        output_thread.start()
+
+        buffer = bytearray(RECV_BUFFER_SIZE)
+        view = memoryview(buffer)
+        stdin_fd = proc.stdin.fileno()
         received = 0
-        filename = f"{int(time.time())}.mp4"
-        # 保存先を指定し書き込みモードで開く
-        with open(filename, 'wb') as f:
+        try:
             while received < file_size:
-                data = client_socket.recv(1400)
-                received += len(data)
-                f.write(data)
-        # 16バイトのメッセージを送る
-        message = "success".ljust(16)
-        client_socket.send(message.encode('utf-8'))
+                n = client_socket.recv_into(view[:min(RECV_BUFFER_SIZE, file_size - received)])
+                if n == 0:
+                    raise ConnectionError(f"ファイル受信中に切断されました: {received}/{file_size} bytes")
+                write_all(stdin_fd, view[:n])
+                received += n
+        except BrokenPipeError:
+            # エンコーダーが先に終了した（エラーの内容は終了コードとstderrで返す）
+            pass
+        except Exception:
+            proc.kill()
+            raise
+        finally:
+            # 入力の終わりを伝えると、エンコーダーは残りを出力して終了する
+            proc.stdin.close()
+            output_thread.join()
+            proc.wait()
+        stderr_file.seek(0)
+        client_socket.sendall(stream_result(proc.returncode, stderr_file.read(), received, sent[0]))
+
+
+# --------------------------------------------------
+# スレッドモード
+# --------------------------------------------------
+def handle_upload(client_socket, client_address, file_size):
+    """通常アップロード: ファイルサイズの後に続くファイル全体を受け取る"""
+    print(f"ファイルサイズ: {file_size}")
+    if file_size > MAX_FILE_SIZE:
+        print(f"ファイルサイズが上限を超えています: {client_address}")
+        send_status(client_socket, "too_large")
+        return
+    temp_path = make_temp_path()
+    digest = new_digest()
+    try:
+        # 保存先を指定し書き込みモードで開く（Pythonのバッファは使わず直接書き込む）
+        with open(temp_path, 'wb', buffering=0) as f:
+            preallocate(f.fileno(), file_size)
+            receive_into_file(client_socket, f.fileno(), 0, file_size, digest)
+    except Exception:
+        # 途中までしか書き込めていないファイルは残さない
+        os.remove(temp_path)
+        raise
+    # 受信しながら計算したハッシュの名前で保存する
+    path = content_store.add(temp_path, digest.hexdigest())
+    print(f"保存しました: {path}")
+    # 16バイトのメッセージを送る
+    send_status(client_socket, "success")
+
+
+def handle_upload_range(client_socket, header):
+    """範囲アップロード: JSONで指定された範囲のデータを受け取り、共有ファイルに書き込む"""
+    params = json.loads(recv_exact(client_socket, parse_json_size(header)))
+    try:
+        upload, offset, length = begin_range(params)
+    except ValueError as e:
+        client_socket.sendall(error_message(str(e)))
+        return
+    try:
+        received = receive_into_file(client_socket, upload.fd, offset, length)
+    except Exception as e:
+        # 途中まで受け取った分はインデックスに記録され、再接続後にその続きから送られる
+        finish_range(upload, offset, length, getattr(e, 'received', 0))
+        raise
+    try:
+        filename = finish_range(upload, offset, length, received)
+    except ValueError as e:
+        client_socket.sendall(error_message(str(e)))
+        return
+    client_socket.sendall(encode_message(STATUS_OK, range_response(upload, filename)))
+
+
+def handle_command(operation, params):
+    """データを伴わないオペレーションを処理して応答を返す（スレッド・asyncio共通）"""
+    try:
+        if operation == OP_QUERY_UPLOAD:
+            return encode_message(STATUS_OK, query_upload(params))
+        if operation == OP_LOOKUP:
+            return encode_message(STATUS_OK, lookup_content(params))
+        if operation == OP_COMPRESS:
+            return encode_message(STATUS_OK, submit_compress(params))
+        if operation == OP_JOB_STATUS:
+            return encode_message(STATUS_OK, job_status(params))
+    except ValueError as e:
+        return error_message(str(e))
+    print(f"不明なオペレーション: {operation}")
+    return error_message("unknown operation")
+
+
+def handle_client(client_socket, client_address):
+    """1つの接続を処理する（スレッドプールのワーカーで実行される）"""
+    print(f"TCP接続: {client_address}")
+    client_socket.settimeout(CONNECTION_TIMEOUT)
+    try:
+        # 最初の32バイトのヘッダーを取得
+        header = recv_exact(client_socket, 32)
+        operation = header[0]
+        if operation == OP_UPLOAD:
+            handle_upload(client_socket, client_address, int.from_bytes(header, 'big'))
+        elif operation == OP_UPLOAD_RANGE:
+            handle_upload_range(client_socket, header)
+        elif operation == OP_STREAM_COMPRESS:
+            handle_stream_compress(client_socket, header)
+        else:
+            params = json.loads(recv_exact(client_socket, parse_json_size(header)))
+            client_socket.sendall(handle_command(operation, params))
     except Exception as e:
         print(f"処理エラー: {e}")
     finally:
         # TCP接続を閉じる
-        client_socket.close()
\ No newline at end of file
+        client_socket.close()
+
+
+def serve_thread():
+    """スレッドプールで複数のクライアントを同時に処理する"""
+    # TCPソケットを作成(TCPは作成->bind->listen->accept
+    tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # socketにIPアドレスとポートをバインド
+    tcp_sock.bind(TCP_ADDRESS)
+    # tcpは待ち受ける数を指定する
+    tcp_sock.listen(LISTEN_BACKLOG)
+    print(f"スレッドモードで起動しました: {TCP_ADDRESS}")
+
+    # 空きワーカーがないときはacceptしない（その間の接続はカーネルのバックログで待たせる）
+    slots = threading.BoundedSemaphore(MAX_CONNECTIONS)
+    with ThreadPoolExecutor(max_workers=MAX_CONNECTIONS) as executor:
+        while True:
+            slots.acquire()
+            # 接続を受け付ける tcpではbind→listen→accept→recvという手順が必要
+            client_socket, client_address = tcp_sock.accept()
+            future = executor.submit(handle_client, client_socket, client_address)
+            future.add_done_callback(lambda _: slots.release())
+
+
+# --------------------------------------------------
+# asyncioモード
+# --------------------------------------------------
+async def receive_into_file_async(reader, fd, offset, length, digest=None):
+    """asyncio版の受信処理。バッファが埋まったら別スレッドでまとめて書き込む"""
+    buffer = bytearray(RECV_BUFFER_SIZE)
+    view = memoryview(buffer)
+    # written: ファイルに書き込み済みのバイト数、filled: バッファに溜まっているバイト数
+    written = 0
+    filled = 0
+    try:
+        while written + filled < length:
+            chunk = await asyncio.wait_for(
+                reader.read(min(RECV_BUFFER_SIZE - filled, length - written - filled)),
+                CONNECTION_TIMEOUT,
+            )
+            if not chunk:
+                raise ConnectionError("相手が切断しました")
+            view[filled:filled + len(chunk)] = chunk
+            filled += len(chunk)
+            if filled == RECV_BUFFER_SIZE or written + filled == length:
+                # ディスク書き込みとハッシュ計算でイベントループを止めないようにする
+                await asyncio.to_thread(write_chunk, fd, view[:filled], offset + written, digest)
+                written += filled
+                filled = 0
+    except (OSError, asyncio.TimeoutError) as e:
+        # 受信済みの分は書き込んでおき、再開時に送り直さなくて済むようにする
+        await asyncio.to_thread(write_at, fd, view[:filled], offset + written)
+        written += filled
+        raise IncompleteTransfer(f"ファイル受信中に中断されました: {written}/{length} bytes ({e})", written) from e
+    return written
+
+
+async def handle_upload_async(reader, writer, client_address, file_size):
+    """asyncio版の通常アップロード"""
+    print(f"ファイルサイズ: {file_size}")
+    if file_size > MAX_FILE_SIZE:
+        print(f"ファイルサイズが上限を超えています: {client_address}")
+        writer.write("too_large".ljust(16).encode('utf-8'))
+        await writer.drain()
+        return
+    temp_path = make_temp_path()
+    digest = new_digest()
+    try:
+        # 最大MAX_FILE_SIZEの領域の確保はループを止めないように別スレッドで行う
+        f = await asyncio.to_thread(open_preallocated, temp_path, file_size)
+        with f:
+            await receive_into_file_async(reader, f.fileno(), 0, file_size, digest)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    path = await asyncio.to_thread(content_store.add, temp_path, digest.hexdigest())
+    print(f"保存しました: {path}")
+    writer.write("success".ljust(16).encode('utf-8'))
+    await writer.drain()
+
+
+async def handle_upload_range_async(reader, writer, header):
+    """asyncio版の範囲アップロード"""
+    json_bytes = await asyncio.wait_for(reader.readexactly(parse_json_size(header)), CONNECTION_TIMEOUT)
+    try:
+        # 領域の事前確保（大きなファイルでは時間がかかる）やuploads_lockの待ちでループを止めないように別スレッドで行う
+        upload, offset, length = await asyncio.to_thread(begin_range, json.loads(json_bytes))
+    except ValueError as e:
+        writer.write(error_message(str(e)))
+        await writer.drain()
+        return
+    try:
+        received = await receive_into_file_async(reader, upload.fd, offset, length)
+    except Exception as e:
+        await asyncio.to_thread(finish_range, upload, offset, length, getattr(e, 'received', 0))
+        raise
+    try:
+        # fsyncやハッシュ計算などコミット時のファイル操作はループの外で行う
+        filename = await asyncio.to_thread(finish_range, upload, offset, length, received)
+    except ValueError as e:
+        writer.write(error_message(str(e)))
+        await writer.drain()
+        return
+    writer.write(encode_message(STATUS_OK, range_response(upload, filename)))
+    await writer.drain()
+
+
+async def handle_stream_compress_async(reader, writer, header):
+    """asyncio版のストリーミング圧縮。パイプとソケットのdrainで背圧を伝える"""
+    json_bytes = await asyncio.wait_for(reader.readexactly(parse_json_size(header)), CONNECTION_TIMEOUT)
+    try:
+        file_size, command = parse_stream_params(json.loads(json_bytes))
+    except ValueError as e:
+        writer.write(error_message(str(e)))
+        await writer.drain()
+        return
+    with tempfile.TemporaryFile() as stderr_file:
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr_file)
+        except FileNotFoundError:
+            writer.write(error_message(f"エンコーダーが見つかりません: {command[0]}"))
+            await writer.drain()
+            return
+
+        writer.write(encode_message(STATUS_OK, {"status": "accepted"}))
+
+        async def pump_output():
+            sent = 0
+            try:
+                while True:
+                    chunk = await proc.stdout.read(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    writer.write(len(chunk).to_bytes(4, 'big'))
+                    writer.write(chunk)
+                    # クライアントの受信が遅いとここで待ち、その間はエンコーダーの出力も読まない
+                    await writer.drain()
+                    sent += len(chunk)
+                writer.write((0).to_bytes(4, 'big'))
+                return sent
+            except Exception:
+                proc.kill()
+                raise
+
+        output_task = asyncio.create_task(pump_output())
+        received = 0
+        try:
+            while received < file_size:
+                chunk = await asyncio.wait_for(
+                    reader.read(min(RECV_BUFFER_SIZE, file_size - received)), CONNECTION_TIMEOUT)
+                if not chunk:
+                    raise ConnectionError(f"ファイル受信中に切断されました: {received}/{file_size} bytes")
+                proc.stdin.write(chunk)
+                # エンコーダーが入力を読み切れていない間は次を受信しない
+                await proc.stdin.drain()
+                received += len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            # エンコーダーが先に終了した（エラーの内容は終了コードとstderrで返す）
+            pass
+        except BaseException:
+            proc.kill()
+            output_task.cancel()
+            await proc.wait()
+            raise
+        finally:
+            proc.stdin.close()
+        sent = await output_task
+        await proc.wait()
+        stderr_file.seek(0)
+        writer.write(stream_result(proc.returncode, stderr_file.read(), received, sent))
+        await writer.drain()
+
+
+async def handle_client_async(reader, writer, slots):
+    """asyncio版の接続処理"""
+    client_address = writer.get_extra_info('peername')
+    print(f"TCP接続: {client_address}")
+    # スレッドモードと同じく同時に処理するのはMAX_CONNECTIONSまで。空くのを待ちきれなかった接続は閉じる
+    try:
+        await asyncio.wait_for(slots.acquire(), CONNECTION_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"同時接続数が上限のため切断します: {client_address}")
+        writer.close()
+        return
+    try:
+        header = await asyncio.wait_for(reader.readexactly(32), CONNECTION_TIMEOUT)
+        operation = header[0]
+        if operation == OP_UPLOAD:
+            await handle_upload_async(reader, writer, client_address, int.from_bytes(header, 'big'))
+        elif operation == OP_UPLOAD_RANGE:
+            await handle_upload_range_async(reader, writer, header)
+        elif operation == OP_STREAM_COMPRESS:
+            await handle_stream_compress_async(reader, writer, header)
+        else:
+            json_bytes = await asyncio.wait_for(reader.readexactly(parse_json_size(header)), CONNECTION_TIMEOUT)
+            writer.write(handle_command(operation, json.loads(json_bytes)))
+            await writer.drain()
+    except Exception as e:
+        print(f"処理エラー: {e}")
+    finally:
+        slots.release()
+        writer.close()
+
+
+async def serve_asyncio():
+    """asyncioのストリームサーバーで複数のクライアントを同時に処理する"""
+    slots = asyncio.Semaphore(MAX_CONNECTIONS)
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_client_async(reader, writer, slots),
+        TCP_ADDRESS[0],
+        TCP_ADDRESS[1],
+        backlog=LISTEN_BACKLOG,
+        reuse_address=True,
+    )
+    print(f"asyncioモードで起動しました: {TCP_ADDRESS}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    mode = sys.argv[1] if len(sys.argv) > 1 else SERVER_MODE
+    load_index()
+    content_store.load()
+    start_encoder_pool()
+    # 再起動しなくても放置されたアップロードの途中のファイルが残り続けないようにする
+    threading.Thread(target=expire_uploads_forever, daemon=True).start()
+    if mode == 'asyncio':
+        asyncio.run(serve_asyncio())
+    elif mode == 'thread':
+        serve_thread()
+    else:
+        print(f"不明なモードです: {mode} (thread または asyncio)")
+        sys.exit(1)